@@ -21,41 +21,74 @@
 # SOFTWARE.
 # ==============================================================================
 
-from copy import deepcopy
+from collections import namedtuple
 import numpy as np
 import math
 import random
-import copy
 from termcolor import colored
 
 
 from game import Game
-
-problematic = [line.strip() for line in open("problematic.txt", 'r')]
-problematic = [int(x) for x in problematic]
+from config import CFG
 
 class BlokusGame(Game):
 
     def __init__(self, n = 14):
         
         self.action_size = 17836
-        self.problematic = problematic
         self.size = self.row = self.column = n 
         self.rounds = 0
         self.current_player = 1
         self.state = np.zeros((n,n), dtype = np.int8)
-        self.pieces = {1: All_Shapes,
-                      -1: All_Shapes
+        # Bitmasks of the pieces each player still holds, bit i for All_Shapes[i].
+        self.pieces = {1: (1 << len(All_Shapes)) - 1,
+                      -1: (1 << len(All_Shapes)) - 1
                         }
         self.score = {1: 0,
                       -1: 0}
+        # Bitboards of the cells each player occupies, bit (row * n + column).
+        self.occupancy = {1: 0,
+                          -1: 0}
 
         max_x = self.size - 1
         max_y = self.size - 1      
-        self.corners = { 1: set([(4, 4)]), 
-                        -1: set([(max_y -4, max_x-4)])
+        self.corners = { 1: frozenset([(4, 4)]), 
+                        -1: frozenset([(max_y -4, max_x-4)])
                         }
+        # Per-player validity vectors kept up to date by play_action, see get_valid_moves.
+        self.legal_moves = {1: None,
+                            -1: None}
+        # Per-player answers of has_legal_move for the current position.
+        self.has_moves = {1: None,
+                          -1: None}
+        # Zobrist hash of the board, the side to move and the piece inventories, kept up to date by play_action.
+        self.hash = self.compute_hash()
+        # Network input planes of both players, kept up to date by play_action, see compute_features.
+        self.feature_planes = FEATURE_PLANES
+        self.features = self.compute_features()
         
+    def clone(self):
+        """
+        Copies the board only. Everything else is an int, a frozenset or an array that play_action replaces rather
+        than modifies, so the clone shares it through shallow copies of the per-player dicts.
+        """
+        game = BlokusGame.__new__(BlokusGame)
+        game.action_size = self.action_size
+        game.size = game.row = game.column = self.size
+        game.rounds = self.rounds
+        game.current_player = self.current_player
+        game.state = self.state.copy()
+        game.pieces = dict(self.pieces)
+        game.score = dict(self.score)
+        game.occupancy = dict(self.occupancy)
+        game.corners = dict(self.corners)
+        game.legal_moves = dict(self.legal_moves)
+        game.has_moves = dict(self.has_moves)
+        game.hash = self.hash
+        game.feature_planes = self.feature_planes
+        game.features = self.features
+        return game
+
     def print_board(self):
         print(self.state)
 
@@ -97,60 +130,279 @@ class BlokusGame(Game):
 
 
     def play_action(self, action):
-
+        """
+        Plays an action and returns an UndoRecord that undo_action uses to take it back.
+        """
         action = self.translate_action(action)
-        # print(action.points)
+        record = UndoRecord(action, self.current_player, self.rounds, dict(self.pieces), dict(self.score),
+                            dict(self.occupancy), dict(self.corners), dict(self.legal_moves), self.has_moves,
+                            self.hash, self.features, self.clone() if CFG.validate_state else None)
+        cell_keys = ZOBRIST_CELL_KEYS[self.current_player + 1]
         for (col, row) in action.points:
             self.state[col, row] = self.current_player
             self.score[self.current_player] += 1
+            self.hash ^= cell_keys[col * self.size + row]
+        self.occupancy[self.current_player] |= action.mask
+        self.hash ^= ZOBRIST_PIECE_KEYS[self.current_player][action.piece] ^ ZOBRIST_SIDE_KEY
 
         self.rounds += 1
-        self.corners[self.current_player].update(self.update_corners(action))
+        new_corners = self.update_corners(action)
+        self.corners[self.current_player] = self.corners[self.current_player] | new_corners
         self.pieces[self.current_player] = self.remove_piece(action)
-        self.corners[-self.current_player] = set([(i, j) for (i, j) in self.corners[-self.current_player] if self.state[i][j] == 0])
+        self.update_legal_moves(self.current_player, action, new_corners)
+        self.has_moves = {1: None,
+                          -1: None}
+        self.corners[-self.current_player] = frozenset([(i, j) for (i, j) in self.corners[-self.current_player] if self.state[i][j] == 0])
+        self.update_features(record)
+
+        self.current_player *= -1
+
+        if CFG.validate_state:
+            assert self.hash == self.compute_hash(), "play_action left an inconsistent hash"
+            assert np.array_equal(self.features, self.compute_features()), "play_action left inconsistent features"
+        return record
 
+    def update_features(self, record):
+        """
+        Updates a copy of the feature planes for the move of record, which play_action has applied to everything else.
+        """
+        player = record.player
+        own = FEATURE_BASE[player]
+        features = self.features.copy()
+
+        rows, columns = zip(*record.placement.points)
+        features[own + OCCUPANCY_PLANE, rows, columns] = 1
+        features[own + FORBIDDEN_PLANE, rows, columns] = 0
+        features[FEATURE_BASE[-player] + FORBIDDEN_PLANE, rows, columns] = 0
+        for (i, j) in record.placement.edges:
+            if self.state[i, j] == 0:
+                features[own + FORBIDDEN_PLANE, i, j] = 1
+        # An anchor changes with the corners, and when its cell gets covered or edge-adjacent to the player.
+        changed = set(record.placement.points) | set(record.placement.edges)
+        for p in [player, -player]:
+            base = FEATURE_BASE[p]
+            for (i, j) in changed | (record.corners[p] ^ self.corners[p]):
+                features[base + CORNER_PLANE, i, j] = ((i, j) in self.corners[p] and self.state[i, j] == 0
+                                                       and not features[base + FORBIDDEN_PLANE, i, j])
+        features[own + PIECE_PLANES + record.placement.piece] = 0
+
+        self.features = features
+
+    def compute_features(self):
+        """
+        Feature planes of both players computed from scratch, as a (FEATURE_PLANES, n, n) uint8 array. Each player has
+        FEATURE_BASE[player] + OCCUPANCY_PLANE for their cells, + CORNER_PLANE for the corners they can still anchor a
+        piece on, that is empty and not forbidden, + FORBIDDEN_PLANE for the empty cells edge-adjacent to their cells
+        and + PIECE_PLANES + i, all ones while they still hold All_Shapes[i]. All of them follow from the board and the
+        pieces alone, so positions with the same hash get the same planes.
+        """
+        features = np.zeros((FEATURE_PLANES, self.size, self.size), dtype=np.uint8)
+        for player in [1, -1]:
+            own = FEATURE_BASE[player]
+            occupied = self.state == player
+            features[own + OCCUPANCY_PLANE] = occupied
+            for (i, j) in self.corners[player]:
+                features[own + CORNER_PLANE, i, j] = 1
+            adjacent = np.zeros_like(occupied)
+            adjacent[1:, :] |= occupied[:-1, :]
+            adjacent[:-1, :] |= occupied[1:, :]
+            adjacent[:, 1:] |= occupied[:, :-1]
+            adjacent[:, :-1] |= occupied[:, 1:]
+            features[own + FORBIDDEN_PLANE] = adjacent & (self.state == 0)
+            # corners may still hold covered or forbidden cells, which are no longer anchors.
+            features[own + CORNER_PLANE] &= (self.state == 0) & ~adjacent
+            for piece in self.remaining_pieces(player):
+                features[own + PIECE_PLANES + piece] = 1
+        return features
+
+    def get_network_input(self):
+        """
+        What the neural network sees of the position: with CFG.input_features, the feature planes with those of the
+        player to move first, otherwise a copy of the board.
+        """
+        if CFG.input_features:
+            return self.features[FEATURE_ORDER[self.current_player]]
+        return self.state.copy()
+
+    def pass_turn(self):
+        """
+        Gives the turn to the other player without a move, for a player who has no legal move left.
+        """
         self.current_player *= -1
+        self.hash ^= ZOBRIST_SIDE_KEY
+
+    def undo_action(self, record):
+        """
+        Takes back the move of an UndoRecord returned by play_action, restoring the exact previous state.
+        Records must be undone in the reverse order they were played.
+        """
+        for (col, row) in record.placement.points:
+            self.state[col, row] = 0
+        self.current_player = record.player
+        self.rounds = record.rounds
+        self.pieces = record.pieces
+        self.score = record.score
+        self.occupancy = record.occupancy
+        self.corners = record.corners
+        self.legal_moves = record.legal_moves
+        self.has_moves = record.has_moves
+        self.hash = record.hash
+        self.features = record.features
+
+        if record.snapshot is not None:
+            assert self.same_state(record.snapshot), "undo_action did not restore the previous state"
+
+    def same_state(self, other):
+        """
+        Returns whether two games are in exactly the same state, caches included.
+        """
+        def same_vectors(a, b):
+            return all((a[p] is None and b[p] is None)
+                       or (a[p] is not None and b[p] is not None and np.array_equal(a[p], b[p])) for p in [1, -1])
+
+        return (self.rounds == other.rounds
+                and self.current_player == other.current_player
+                and np.array_equal(self.state, other.state)
+                and self.state.dtype == other.state.dtype
+                and self.pieces == other.pieces
+                and self.score == other.score
+                and self.occupancy == other.occupancy
+                and self.corners == other.corners
+                and same_vectors(self.legal_moves, other.legal_moves)
+                and self.has_moves == other.has_moves
+                and self.hash == other.hash
+                and np.array_equal(self.features, other.features))
+
+    def compute_hash(self):
+        """
+        64-bit Zobrist hash of the board, the side to move and the pieces each player still holds, computed from
+        scratch. play_action maintains the same value incrementally in self.hash, which keys the neural network's
+        evaluation cache.
+        """
+        cells = np.arange(self.size * self.size)
+        key = int(np.bitwise_xor.reduce(ZOBRIST_CELLS[self.state.ravel() + 1, cells]))
+        if self.current_player == -1:
+            key ^= ZOBRIST_SIDE_KEY
+        for player in [1, -1]:
+            for piece in self.remaining_pieces(player):
+                key ^= ZOBRIST_PIECE_KEYS[player][piece]
+        return key
 
     
     def get_valid_moves(self, current_player):
+        if CFG.move_generator == "incremental":
+            if self.legal_moves[current_player] is None:
+                self.legal_moves[current_player] = self.get_valid_moves_vectorized(current_player)
+            return self.legal_moves[current_player].copy()
+        if CFG.move_generator == "vectorized":
+            return self.get_valid_moves_vectorized(current_player)
 
         all_moves = np.zeros(self.action_size, dtype = np.int8)
-        list_of_legals = self.get_legal_moves(current_player)
-        for i in list_of_legals:
-            # get_legal_moves for some reason doesn't capture all illegal moves - adhoc solution is self.problematic
-            if i not in self.problematic:
-                all_moves[i] = 1
+        all_moves[self.get_legal_moves(current_player)] = 1
 
+        return all_moves
 
+    def get_valid_moves_vectorized(self, current_player):
+        """
+        Computes the whole validity vector at once from the precomputed placement arrays: a placement is valid when
+        its anchor is one of the player's corners, its piece is still available and none of its cells is blocked.
+        Blocked cells are the occupied ones plus, after the first round, those edge-adjacent to the player's pieces.
+        Only the placements of each corner anchor are gathered, the rest of the vector stays zero.
+        """
+        all_moves = np.zeros(self.action_size, dtype=np.int8)
+        all_moves[self.valid_anchored_actions(current_player, self.corners[current_player])] = 1
         return all_moves
 
-    def check_game_over(self, current_player):
-        # print('CHECKING GAME')
-        moves = []
-        for player in [1, -1]:
-            moves.extend(self.get_valid_moves(player))
-            if sum(moves) > 0:
-                return False, 0
+    def valid_anchored_actions(self, current_player, anchors):
+        """
+        Returns the action numbers of the valid placements anchored at the given cells.
+        """
+        n = self.size
+        if not anchors:
+            return np.zeros(0, dtype=np.int32)
+
+        blocked = self.state != 0
+        if self.rounds >= 2:
+            own = self.state == current_player
+            blocked[1:, :] |= own[:-1, :]
+            blocked[:-1, :] |= own[1:, :]
+            blocked[:, 1:] |= own[:, :-1]
+            blocked[:, :-1] |= own[:, 1:]
+        # The extra cell pads placements with fewer than five points and is never blocked.
+        blocked = np.append(blocked.ravel(), False)
+
+        pieces = (self.pieces[current_player] & PIECE_BITS) != 0
+        candidates = np.concatenate([ANCHOR_PLACEMENTS[x * n + y] for (x, y) in anchors])
+
+        valid = pieces[PLACEMENT_PIECE[candidates]] & ~blocked[PLACEMENT_CELLS[candidates]].any(axis=1)
+        return PLACEMENT_ACTIONS[candidates[valid]]
+
+    def update_legal_moves(self, player, placement, new_corners):
+        """
+        Patches the cached validity vectors after player played placement, instead of regenerating them. The player
+        loses every placement of that piece or touching the placed cells, and gains the valid placements anchored at
+        its new corners. The opponent only loses the placements covering those cells.
+        """
+        if self.rounds <= 2:
+            # Edge-adjacency only counts from the second round on, so the first round caches are dropped instead.
+            self.legal_moves = {1: None,
+                                -1: None}
+            return
+
+        # The vectors may be shared with clones, so they are patched on a copy.
+        cells = [i * self.size + j for (i, j) in placement.points]
+        if self.legal_moves[player] is not None:
+            own = self.legal_moves[player].copy()
+            own[PIECE_PLACEMENTS[placement.piece]] = 0
+            for cell in cells:
+                own[CELL_PLACEMENTS[cell]] = 0
+                own[EDGE_PLACEMENTS[cell]] = 0
+            own[self.valid_anchored_actions(player, new_corners)] = 1
+            self.legal_moves[player] = own
+
+        if self.legal_moves[-player] is not None:
+            opponent = self.legal_moves[-player].copy()
+            for cell in cells:
+                opponent[CELL_PLACEMENTS[cell]] = 0
+            self.legal_moves[-player] = opponent
+
+    def has_legal_move(self, player):
+        """
+        Returns whether a player has at least one legal move. Uses the cached validity vector when there is one,
+        otherwise stops at the first valid placement. The answer is cached until the next play_action.
+        """
+        if self.has_moves[player] is None:
+            if self.legal_moves[player] is not None:
+                self.has_moves[player] = bool(self.legal_moves[player].any())
+            else:
+                self.has_moves[player] = next(self.iter_legal_moves_bitboard(player), None) is not None
+        return self.has_moves[player]
 
-        if sum(moves) > 0:
+    def check_game_over(self, current_player):
+        if self.has_legal_move(1) or self.has_legal_move(-1):
             return False, 0
         elif self.score[current_player] >= self.score[-current_player]:
             return True, 1
         else:
             return True, -1
 
-        return True, 0
     def remove_piece(self, piece):
         """
-        Removes a given piece (Shape object) from the list of pieces a player has.
+        Removes a given piece (Placement) from the bitmask of pieces a player has.
         """
-        new_pieces = [s for s in self.pieces[self.current_player] if s.ID != piece.ID]
-        return new_pieces   
+        return self.pieces[self.current_player] & ~(1 << piece.piece)
+
+    def remaining_pieces(self, player):
+        """
+        Returns the indices in All_Shapes of the pieces a player still holds.
+        """
+        pieces = self.pieces[player]
+        return [index for index in range(len(All_Shapes)) if pieces >> index & 1]
 
     def update_corners(self, action):
         """
-        Updates the available corners of a player.
-        Placement should be in the form of a Shape object.
+        Returns the new corner anchors of a player created by a given Placement: its diagonal cells that are on the
+        board and still empty.
         """
         new_corners = set()
         for c in action.corners:
@@ -233,145 +485,70 @@ class BlokusGame(Game):
         else:
             return True
 
+    def valid_placement(self, placement, player_label):
+        """
+        Same checks as valid_move, for a precomputed Placement. Placements in the table always lie inside the board.
+        """
+        state = self.state
+        if any(state[i, j] for (i, j) in placement.points):
+            return False
+        if self.rounds < 2: # first actions haven't been done yet
+            return any(pt in self.corners[player_label] for pt in placement.points)
+        return (not any(state[i, j] == player_label for (i, j) in placement.edges)
+                and any(state[i, j] == player_label for (i, j) in placement.corners))
+
     def get_legal_moves(self, player_label):
-        # print('WERE IN GET LEGAL MOVES')
+        if CFG.move_generator == "bitboard":
+            return self.get_legal_moves_bitboard(player_label)
+
         placements = []
-        visited = []
         # Loop through every available corner.
-        for cr in self.corners[player_label]:
-            # Look through every piece offered. (This will be restricted according to certain algorithms.)
-            for sh in self.pieces[player_label]:
-                # Create a new shape so that the one in the player's list of shapes is not overwritten.
-                try_out = copy.deepcopy(sh)
-                # Loop over every potential refpt the piece could have.
-                # for num in range(try_out.size):
-                try_out.create(0, cr)
-                # And every possible flip.
-                for fl in try_out.flips:
-                    temp_fl = copy.deepcopy(try_out)
-                    temp_fl.flip(fl)
-                    # And every possible orientation.
-                    for rot in try_out.rots:
-                        temp_rot = copy.deepcopy(temp_fl)
-                        temp_rot.rotate(rot)
-                        candidate = copy.deepcopy(temp_rot)
-                        if fl == 'h':
-                            f = 1
-                        else:
-                            f = 0
-                        
-
-
-                        if candidate.ID not in ['I5', 'I4','I3','I2']:
-                            encoding = (cr[0] * 14 + cr[1]) * 91 + temp_rot.shift + (rot//90)*2 + f
-                        else:
-                            encoding = (cr[0] * 14 + cr[1]) * 91 + temp_rot.shift + (rot//90)*1 + f
-
-                        if self.valid_move(candidate.points, player_label):
-                            if not (set(candidate.points) in visited):
-                                placements.append(encoding) 
-                                visited.append(set(candidate.points))
+        for (x, y) in self.corners[player_label]:
+            anchored = ANCHORED_PLACEMENTS[x * self.size + y]
+            # Look through every piece offered, in every distinct flip and orientation.
+            for piece in self.remaining_pieces(player_label):
+                for placement in anchored[piece]:
+                    if self.valid_placement(placement, player_label):
+                        placements.append(placement.action)
         return placements
 
+    def get_legal_moves_bitboard(self, player_label):
+        """
+        Bitboard version of get_legal_moves: overlap, edge-adjacency and corner-contact are each a single AND
+        against the players' occupancy. Returns the same moves in the same order.
+        """
+        return list(self.iter_legal_moves_bitboard(player_label))
+
+    def iter_legal_moves_bitboard(self, player_label):
+        """
+        Generates the legal action numbers of get_legal_moves_bitboard one at a time.
+        """
+        own = self.occupancy[player_label]
+        occupied = own | self.occupancy[-player_label]
+        # In the first round the anchor itself is one of the player's corners, so only overlap matters.
+        first_round = self.rounds < 2
+        for (x, y) in self.corners[player_label]:
+            anchored = ANCHORED_PLACEMENTS[x * self.size + y]
+            for piece in self.remaining_pieces(player_label):
+                for placement in anchored[piece]:
+                    if placement.mask & occupied:
+                        continue
+                    if not first_round and (placement.edge_mask & own or not placement.corner_mask & own):
+                        continue
+                    yield placement.action
 
     def translate_action(self, input_number):
-        position = input_number // 91
-        input_number = input_number % 91
-        if input_number < 8:
-            piece = All_Shapes[0]
-            rotation = input_number // 2
-            fl = input_number % 2
-        elif input_number < 16:
-            piece = All_Shapes[1]
-            rotation = (input_number % 8 )// 2
-            fl = input_number % 2
-        elif input_number < 24:
-            piece = All_Shapes[2]
-            rotation = (input_number % 8 )// 2
-            fl = input_number % 2
-        elif input_number < 32:
-            piece = All_Shapes[3]
-            rotation = (input_number % 8 )// 2
-            fl = input_number % 2    
-        elif input_number < 40:
-            piece = All_Shapes[4]
-            rotation = (input_number % 8 )// 2
-            fl = input_number % 2
-        elif input_number < 48:
-            piece = All_Shapes[5]
-            rotation = (input_number % 8 )// 2
-            fl = input_number % 2
-        elif input_number < 52:
-            piece = All_Shapes[6]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 56:
-            piece = All_Shapes[7]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 60:
-            piece = All_Shapes[8]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 64:
-            piece = All_Shapes[9]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 68:
-            piece = All_Shapes[10]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 72:
-            piece = All_Shapes[11]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 76:
-            piece = All_Shapes[12]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 80:
-            piece = All_Shapes[13]
-            rotation = (input_number % 4 )// 2
-            fl = input_number % 2
-        elif input_number < 82:
-            piece = All_Shapes[14]
-            rotation = input_number % 2 
-            fl = 0
-        elif input_number < 84:
-            piece = All_Shapes[15]
-            rotation = input_number % 2 
-            fl = 0
-        elif input_number < 86:
-            piece = All_Shapes[16]
-            rotation = input_number % 2 
-            fl = 0
-        elif input_number < 88:
-            piece = All_Shapes[17]
-            rotation = 0 
-            fl = 0
-        elif input_number < 89:
-            piece = All_Shapes[18]
-            rotation = 0 
-            fl = 0
-        elif input_number < 90:
-            piece = All_Shapes[19]
-            rotation = 0 
-            fl = 0
-        elif input_number < 91:
-            piece = All_Shapes[20]
-            rotation = 0 
-            fl = 0
-
-        position_x = int(position // 14)
-        position_y = position % 14
-        if fl == 0: 
-            fl = "None" 
-        else: fl = "h"
-        piece.create(0, (position_x, position_y))
-        piece.flip(fl)
-        piece.rotate(90 * rotation)
-        
-        return piece
+        """
+        Returns the precomputed Placement for an action number, or None if that placement leaves the board.
+        Actions duplicating another orientation's cells decode to that orientation's canonical Placement.
+        """
+        return PLACEMENTS[input_number]
+
+    def find_placement(self, points):
+        """
+        Returns the canonical Placement covering exactly the given cells, or None if no piece fits them on the board.
+        """
+        return POINTS_PLACEMENTS.get(frozenset(points))
 
 
 
@@ -703,3 +880,151 @@ class Y(Shape):
         self.corners = [(x + 3, y - 1), (x + 3, y + 1), (x + 1, y + 2), (x - 1, y + 2), (x - 2, y + 1), (x - 2, y - 1)]
 
 All_Shapes = [N(), L5(), Y(), P(), F(), L4(), T4(), V5(), T5(), U(), Z5(), Z4(), W(), V3(), I5(), I4(), I3(), I2(), X(), O4(), I1()]
+
+
+Placement = namedtuple("Placement", ["action", "piece", "ID", "points", "corners", "edges",
+                                     "mask", "edge_mask", "corner_mask"])
+
+# What play_action changed, so that undo_action can restore it. snapshot is a clone of the game before the move
+# when CFG.validate_state is set, None otherwise.
+UndoRecord = namedtuple("UndoRecord", ["placement", "player", "rounds", "pieces", "score", "occupancy", "corners",
+                                       "legal_moves", "has_moves", "hash", "features", "snapshot"])
+
+def build_placement_table(size=14):
+    """
+    Precomputes every (anchor cell, piece, flip, rotation) placement on a size x size board, using the same encoding
+    as get_legal_moves: (cell * 91 + shift + orientation). Each shape is oriented once around the origin and then
+    translated to every anchor cell, so no Shape objects are needed at runtime.
+
+    Symmetric pieces reach the same cells with several orientations. Only the first one in flip then rotation order
+    is canonical: the other action numbers map to its Placement and are never generated as legal moves.
+
+    Returns a list indexed by action number holding a Placement (None if the placement leaves the board), and for
+    every anchor cell, a list per piece of the canonical Placements anchored there, in flip then rotation order.
+    The *mask fields are bitboards with bit (row * size + column) set for each cell.
+    """
+    table = [None] * (size * size * 91)
+    anchored = [[[] for _ in All_Shapes] for _ in range(size * size)]
+    canonical = {}
+
+    def on_board(p):
+        return 0 <= p[0] < size and 0 <= p[1] < size
+
+    def to_mask(cells):
+        mask = 0
+        for (i, j) in cells:
+            mask |= 1 << (i * size + j)
+        return mask
+
+    for index, shape in enumerate(All_Shapes):
+        for fl in shape.flips:
+            f = 1 if fl == 'h' else 0
+            for rot in shape.rots:
+                shape.create(0, (0, 0))
+                shape.flip(fl)
+                shape.rotate(rot)
+                if shape.ID in ['I5', 'I4', 'I3', 'I2']:
+                    orientation = (rot // 90) * 1 + f
+                else:
+                    orientation = (rot // 90) * 2 + f
+                offsets = list(shape.points)
+                corner_offsets = list(shape.corners)
+
+                for x in range(size):
+                    for y in range(size):
+                        points = tuple((x + i, y + j) for (i, j) in offsets)
+                        if not all(on_board(p) for p in points):
+                            continue
+                        corners = tuple((x + i, y + j) for (i, j) in corner_offsets if on_board((x + i, y + j)))
+                        edges = set()
+                        for (i, j) in points:
+                            edges.update([(i + 1, j), (i - 1, j), (i, j + 1), (i, j - 1)])
+                        edges = tuple(sorted(p for p in edges if on_board(p) and p not in points))
+
+                        action = (x * size + y) * 91 + shape.shift + orientation
+                        mask = to_mask(points)
+                        if mask in canonical:
+                            table[action] = canonical[mask]
+                            continue
+                        placement = Placement(action, index, shape.ID, points, corners, edges,
+                                              mask, to_mask(edges), to_mask(corners))
+                        canonical[mask] = table[action] = placement
+                        anchored[x * size + y][index].append(placement)
+
+    return table, anchored
+
+def build_action_space(table, size=14):
+    """
+    Enumerates the distinct (canonical) placements in action order and gives each a dense index.
+
+    Returns, indexed by dense index: the action number, the covered cells (padded with the dummy cell size * size)
+    and the piece index. Also returns, for every anchor cell, the range of dense indices anchored there, which is
+    contiguous because action numbers are grouped by anchor.
+    """
+    canonical = [placement for (action, placement) in enumerate(table)
+                 if placement is not None and placement.action == action]
+
+    actions = np.array([placement.action for placement in canonical], dtype=np.int32)
+    cells = np.full((len(canonical), 5), size * size, dtype=np.int32)
+    for index, placement in enumerate(canonical):
+        cells[index, :len(placement.points)] = [i * size + j for (i, j) in placement.points]
+    pieces = np.array([placement.piece for placement in canonical], dtype=np.int32)
+
+    starts = np.searchsorted(actions // 91, np.arange(size * size + 1))
+    anchor_ranges = [np.arange(starts[cell], starts[cell + 1]) for cell in range(size * size)]
+
+    return actions, cells, pieces, anchor_ranges
+
+def build_cell_index(table, size=14):
+    """
+    Inverted indices over the canonical placements, used by update_legal_moves: the action numbers of the placements
+    covering each cell, of those edge-adjacent to each cell, and of those using each piece.
+    """
+    covering = [[] for _ in range(size * size)]
+    adjacent = [[] for _ in range(size * size)]
+    using = [[] for _ in All_Shapes]
+    for (action, placement) in enumerate(table):
+        if placement is None or placement.action != action:
+            continue
+        for (i, j) in placement.points:
+            covering[i * size + j].append(action)
+        for (i, j) in placement.edges:
+            adjacent[i * size + j].append(action)
+        using[placement.piece].append(action)
+
+    def to_arrays(lists):
+        return [np.array(actions, dtype=np.int32) for actions in lists]
+
+    return to_arrays(covering), to_arrays(adjacent), to_arrays(using)
+
+PLACEMENTS, ANCHORED_PLACEMENTS = build_placement_table()
+PLACEMENT_ACTIONS, PLACEMENT_CELLS, PLACEMENT_PIECE, ANCHOR_PLACEMENTS = build_action_space(PLACEMENTS)
+CELL_PLACEMENTS, EDGE_PLACEMENTS, PIECE_PLACEMENTS = build_cell_index(PLACEMENTS)
+# Every orientation of a symmetric piece maps its cells to the same canonical Placement.
+POINTS_PLACEMENTS = {frozenset(placement.points): placement for placement in PLACEMENTS if placement is not None}
+PIECE_BITS = 1 << np.arange(len(All_Shapes))
+
+# Layout of BlokusGame.features: per player, starting at FEATURE_BASE[player], an occupancy, a corner and a forbidden
+# plane, then one plane per piece. FEATURE_ORDER[player] lists the planes with those of player first.
+OCCUPANCY_PLANE, CORNER_PLANE, FORBIDDEN_PLANE, PIECE_PLANES = 0, 1, 2, 3
+PLAYER_PLANES = PIECE_PLANES + len(All_Shapes)
+FEATURE_PLANES = 2 * PLAYER_PLANES
+FEATURE_BASE = {1: 0, -1: PLAYER_PLANES}
+FEATURE_ORDER = {1: np.arange(FEATURE_PLANES), -1: np.roll(np.arange(FEATURE_PLANES), PLAYER_PLANES)}
+
+def build_zobrist_keys(size=14, seed=20190101):
+    """
+    Random 64-bit keys for Zobrist hashing: one per (cell value + 1, cell), with zeros for empty cells, one for
+    player -1 to move and one per (player, piece still held). The seed is fixed so that every process, including
+    spawned self-play workers, hashes the same position to the same key.
+    """
+    rng = np.random.RandomState(seed)
+    cells = rng.randint(0, 2 ** 64, size=(3, size * size), dtype=np.uint64)
+    cells[1] = 0
+    side = rng.randint(0, 2 ** 64, dtype=np.uint64)
+    pieces = rng.randint(0, 2 ** 64, size=(2, len(All_Shapes)), dtype=np.uint64)
+    return cells, int(side), {1: pieces[0].tolist(), -1: pieces[1].tolist()}
+
+ZOBRIST_CELLS, ZOBRIST_SIDE_KEY, ZOBRIST_PIECE_KEYS = build_zobrist_keys()
+# The cell keys as Python ints, for the per-move updates of play_action.
+ZOBRIST_CELL_KEYS = ZOBRIST_CELLS.tolist()
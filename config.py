@@ -51,6 +51,53 @@ class CFG(object):
         record_loss: Binary to record policy and value loss to a file.
         loss_file: Name of the file to record loss.
         game: Number of the game. 0: Blokus
+        move_generator: Blokus move generation backend, "table", "bitboard",
+            "vectorized" or "incremental".
+        fpu_value: Q value assumed for unvisited children during selection
+            (first-play urgency).
+        tie_break: How MCTS selection resolves equal Q + U values, "first"
+            or "random".
+        mcts_batch_size: Number of leaves MCTS collects with virtual loss and
+            evaluates in one network call.
+        virtual_loss: Value subtracted from a path while its leaf waits for
+            evaluation.
+        num_workers: Number of self-play processes. Above 1, games are played
+            in parallel and share batched evaluations of the network.
+        validate_state: Binary to check that every undo_action restores the
+            exact previous game state, and that after every play_action the
+            incremental Zobrist hash and feature planes match compute_hash()
+            and compute_features().
+        async_games: Number of self-play games played at once by each
+            process. Above 1, the games run as asyncio coroutines whose
+            leaves are evaluated in shared batches.
+        eval_batch_size: Maximum number of states in one shared batch of
+            the asyncio self-play games.
+        eval_timeout: Seconds a leaf of the asyncio self-play games waits for
+            a fuller batch.
+        eval_cache_size: Maximum number of network predictions cached by
+            position hash, 0 to turn the cache off.
+        eval_cache_memory: Maximum megabytes of cached network predictions,
+            which only keep the probabilities of the valid moves.
+        transpositions: Binary to search a DAG, sharing one MCTS node between
+            all move orders that reach the same position.
+        sparse_policy: Binary to compute and return the policy only at the
+            valid moves, and to store sparse policy training targets.
+        policy_head: Network policy head, "dense" for a dense layer over
+            the flattened board or "conv" for 91 convolutional planes, one
+            per piece orientation, over the board.
+        input_features: Binary to feed the network the occupancy, corner,
+            forbidden cell and remaining piece planes kept by the game
+            instead of the raw board.
+        full_search_prob: Probability that a self-play move gets a full
+            search of num_mcts_sims with Dirichlet noise and is recorded for
+            training. The other moves only get a fast search.
+        fast_mcts_sims: Number of MCTS simulations of the fast searches.
+        early_stop: Binary to stop a search early when the root has a single
+            valid move or its most visited move can no longer be overtaken.
+        search_time_ms: Milliseconds after which a search stops, 0 for no
+            limit.
+        move_time_ms: Milliseconds the computer thinks per move against a
+            human, 0 to use num_mcts_sims instead.
     """
     num_iterations = 100
     num_games = 10
@@ -76,3 +123,24 @@ class CFG(object):
     record_loss = 1
     loss_file = "loss_new.txt"
     game = 2
+    move_generator = "incremental"
+    fpu_value = 0.0
+    tie_break = "first"
+    mcts_batch_size = 1
+    virtual_loss = 1.0
+    num_workers = 1
+    validate_state = 0
+    async_games = 1
+    eval_batch_size = 256
+    eval_timeout = 0.005
+    eval_cache_size = 4096
+    eval_cache_memory = 64
+    transpositions = 0
+    sparse_policy = 0
+    policy_head = "dense"
+    input_features = 0
+    full_search_prob = 1.0
+    fast_mcts_sims = 10
+    early_stop = 0
+    search_time_ms = 0
+    move_time_ms = 0
@@ -0,0 +1,101 @@
+# MIT License
+#
+# Copyright (c) 2019 Yurii Tolochko & Blanyal D'Souza.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+"""Class to cache the evaluations of the neural network."""
+from collections import OrderedDict
+
+
+class EvaluationCache(object):
+    """A least recently used cache of network outputs keyed by position hash.
+
+    The cache is bounded both by a number of entries and by the memory of
+    the cached probability arrays. The least recently used entries are
+    evicted first.
+
+    Attributes:
+        max_entries: An integer for the maximum number of entries, 0 turns
+            the cache off.
+        max_bytes: An integer for the maximum bytes of cached arrays.
+        entries: An OrderedDict mapping keys to (pi, v) tuples, least
+            recently used first.
+        num_bytes: An integer for the bytes of the cached arrays.
+        hits: An integer counting the lookups that found an entry.
+        misses: An integer counting the lookups that found none.
+        evictions: An integer counting the entries evicted to make room.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        """Initializes an empty EvaluationCache with its bounds."""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Looks up the network output for a position.
+
+        Args:
+            key: An integer hash of the position.
+
+        Returns:
+            The cached (pi, v) tuple, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, pi, v):
+        """Stores the network output for a position.
+
+        Args:
+            key: An integer hash of the position.
+            pi: An array of probabilities, which must not be modified
+                afterwards.
+            v: A value scalar.
+        """
+        if self.max_entries <= 0 or key in self.entries:
+            return
+
+        self.entries[key] = (pi, v)
+        self.num_bytes += pi.nbytes
+
+        while (len(self.entries) > self.max_entries or
+               self.num_bytes > self.max_bytes):
+            _, (old_pi, _) = self.entries.popitem(last=False)
+            self.num_bytes -= old_pi.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """Drops all entries, keeping the counters."""
+        self.entries.clear()
+        self.num_bytes = 0
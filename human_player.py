@@ -23,8 +23,7 @@
 
 from mcts import MonteCarloTreeSearch, TreeNode
 from config import CFG
-
-from copy import deepcopy
+from blokus.blokus_game import All_Shapes
 
 
 class Human_player():
@@ -53,14 +52,15 @@ class Human_player():
         # get coordinates
 
         # choose piece
-        if len(game.pieces[self.human_player]) > 0: 
+        pieces = [All_Shapes[index] for index in game.remaining_pieces(self.human_player)]
+        if len(pieces) > 0: 
             
             print('Select a piece from :')
-            for i, piece in enumerate(game.pieces[self.human_player]):
+            for i, piece in enumerate(pieces):
                 print(i, piece.ID) # , end = ''
             
             selected_ID = -1
-            while selected_ID < 0 or selected_ID >= len(game.pieces[self.human_player]):
+            while selected_ID < 0 or selected_ID >= len(pieces):
                 try:
                     selected_ID  = int(input('Select a piece by its number'))
                 except:
@@ -69,70 +69,84 @@ class Human_player():
             print('You have no pieces left')
             return None
 
-        selected_piece = game.pieces[self.human_player][selected_ID]
+        selected_piece = pieces[selected_ID]
         # choose reference point
         refpt = self.get_coords()
         flip, rot = -1, -1
 
+        # Only the flips and rotations of the piece are offered, the others repeat its placements.
         # choose flip
+        if len(selected_piece.flips) == 1:
+            flip = 0
         while (flip != 0) and (flip != 1):
             flip = int(input('Do you want to flip? 1 or 0: '))
 
         # choose rotation
-        while (rot != 0) and (rot != 1) and (rot != 2) and (rot != 3):
-            rot = int(input('Which rotation? 0, 1, 2, 3 corresponds 0, 90, 180, 270 degrees: '))
+        rots = len(selected_piece.rots)
+        if rots == 1:
+            rot = 0
+        while rot not in range(rots):
+            rot = int(input('Which rotation? ' + ', '.join(str(r) for r in range(rots)) + ' corresponds '
+                            + ', '.join(str(d) for d in selected_piece.rots) + ' degrees: '))
 
         return selected_piece, refpt, rot, flip
 
     def play(self):
 
         mcts = MonteCarloTreeSearch(self.net)
-        game = deepcopy(self.game)
+        game = self.game.clone()
         game_over = False
         value = 0
         node = TreeNode()
-        valid = 0
         # self.game.colorBoard()
         game.print_board()
 
         while not game_over:
             
             if game.current_player == self.human_player:
-                valid = False
-                while valid == False: 
+                valid_moves = game.get_valid_moves(self.human_player)
+                if not valid_moves.any():
+                    print('YOU HAVE NO LEGAL MOVE, PASSING')
+                    game.pass_turn()
+                    node = mcts.advance(node, None, game)
+                    game_over, value = game.check_game_over(game.current_player)
+                    continue
+
+                action = None
+                while action is None:
                     piece, refpt, rot, flip = self.get_input(game)
                     piece.create(0, (refpt[0], refpt[1]))
 
                     f = 'None'
-                    if flip == 0:
-                        f == 'None'
-                    else:
+                    if flip == 1:
                         f = 'h'
 
                     piece.flip(f)
                     piece.rotate(90*rot)
 
-                    valid = game.valid_move(piece.points, self.human_player)
-                    
-
-                    if valid == False:
+                    # Look the move up by its cells, which also gives the canonical action of symmetric pieces.
+                    placement = game.find_placement(piece.points)
+                    if placement is None or not valid_moves[placement.action]:
                         print('You selected an illegal move, please reselect')
-                        # print('attempting', piece.points)
-                        # print('corners are ', game.corners[self.human_player])
-
-                    if piece.ID not in ['I5', 'I4','I3','I2']:
-                        encoding = (refpt[0] * 14 + refpt[1]) * 91 + piece.shift + (rot//90)*2 + flip
                     else:
-                        encoding = (refpt[0] * 14 + refpt[1]) * 91 + piece.shift + (rot//90)*1 + flip
+                        action = placement.action
 
-                best_child = TreeNode()
-                best_child.action = encoding
                 print('CHOICE WAS MADE BY A HUMAN TO PLAY', piece.ID, '@', refpt)
             
             else:
-                best_child = mcts.search(game, node, CFG.temp_final)
+                if CFG.move_time_ms > 0:
+                    best_child, stats = mcts.search_for(game, node, CFG.move_time_ms)
+                    print('SEARCHED', stats['simulations'], 'SIMULATIONS IN', int(stats['elapsed_ms']), 'MS')
+                else:
+                    best_child, _ = mcts.search(game, node, CFG.temp_final)
+                if best_child is None:
+                    print('NO MOVE LEFT, PASSING')
+                    game.pass_turn()
+                    node = mcts.advance(node, None, game)
+                    game_over, value = game.check_game_over(game.current_player)
+                    continue
+                action = best_child.action
 
-            action = best_child.action
             game.play_action(action)
 
             game.print_board()
@@ -140,8 +154,8 @@ class Human_player():
 
             game_over, value = game.check_game_over(game.current_player)
 
-            best_child.parent = None
-            node = best_child
+            # Keep the subtree of the move played, whoever chose it.
+            node = mcts.advance(node, action, game)
 
 
         if value == self.human_player * game.current_player:
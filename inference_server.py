@@ -0,0 +1,298 @@
+# MIT License
+#
+# Copyright (c) 2019 Yurii Tolochko & Blanyal D'Souza.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+"""Classes to share one neural network between self-play games."""
+import asyncio
+from multiprocessing.connection import wait
+
+import numpy as np
+
+
+class RemoteNetwork(object):
+    """Stands in for NeuralNetworkWrapper inside a self-play worker process.
+
+    Predictions are sent over a pipe to the InferenceServer, which answers
+    with the output of the real network.
+
+    Attributes:
+        connection: The worker's end of the pipe to the InferenceServer.
+    """
+
+    def __init__(self, connection):
+        """Initializes RemoteNetwork with the pipe to the server."""
+        self.connection = connection
+
+    def predict(self, state, key=None, valid_moves=None):
+        """Predicts move probabilities and state values given a game state.
+
+        Args:
+            state: A list containing the game state in matrix form.
+            key: An optional hash of the position for the network's cache.
+            valid_moves: An optional vector of the valid moves to restrict
+                the probabilities to.
+
+        Returns:
+            A probability vector and a value scalar
+        """
+        keys = None if key is None else [key]
+        if valid_moves is not None:
+            valid_moves = np.asarray(valid_moves)[np.newaxis, :]
+        pis, vs = self.predict_batch(np.asarray(state)[np.newaxis, :, :], keys,
+                                     valid_moves)
+
+        return pis[0], vs[0]
+
+    def predict_batch(self, states, keys=None, valid_moves=None):
+        """Predicts move probabilities and state values for several states.
+
+        Args:
+            states: An array of game states in matrix form, shaped
+                (N, row, column).
+            keys: An optional sequence of N position hashes for the
+                network's cache.
+            valid_moves: An optional (N, action_size) array of the valid
+                moves to restrict the probabilities to.
+
+        Returns:
+            An (N, action_size) array of probability vectors and an (N,)
+            array of values.
+        """
+        self.connection.send(("predict",
+                              (np.asarray(states), keys, valid_moves)))
+
+        return self.connection.recv()
+
+
+def merge_requests(requests):
+    """Stacks the (states, keys, valid_moves) of several requests into one.
+
+    The keys and valid moves are dropped unless every request has them.
+
+    Args:
+        requests: A list of (states, keys, valid_moves) tuples.
+
+    Returns:
+        A tuple of the stacked states, the joined keys or None and the
+        stacked valid moves or None.
+    """
+    states = np.concatenate([states for states, _, _ in requests])
+    keys = None
+    if all(keys is not None for _, keys, _ in requests):
+        keys = [key for _, keys, _ in requests for key in keys]
+    valid_moves = None
+    if all(valid is not None for _, _, valid in requests):
+        valid_moves = np.concatenate([valid for _, _, valid in requests])
+
+    return states, keys, valid_moves
+
+
+class InferenceServer(object):
+    """Evaluates the states of several self-play workers in shared batches.
+
+    Whenever workers are waiting, the states of all pending requests are
+    stacked into a single forward pass of the network and the results are
+    split back to each worker.
+
+    Attributes:
+        net: A NeuralNetworkWrapper used for the forward passes.
+        connections: A list of the server's ends of the worker pipes.
+    """
+
+    def __init__(self, net, connections):
+        """Initializes InferenceServer with the network and worker pipes."""
+        self.net = net
+        self.connections = connections
+
+    def serve(self):
+        """Answers prediction requests until every worker is done.
+
+        A worker is done when it sends ("done", result) instead of
+        ("predict", states). A worker that fails sends ("error",
+        traceback) instead.
+
+        Returns:
+            A list of the results sent by the workers.
+
+        Raises:
+            RuntimeError: A worker failed or exited before it was done.
+        """
+        results = []
+        open_connections = list(self.connections)
+
+        while open_connections:
+            requests = []
+            for connection in wait(open_connections):
+                worker = self.connections.index(connection)
+                try:
+                    kind, payload = connection.recv()
+                except EOFError:
+                    raise RuntimeError("Self-play worker {} exited before "
+                                       "it was done".format(worker))
+                if kind == "error":
+                    raise RuntimeError("Self-play worker {} failed:\n{}"
+                                       .format(worker, payload))
+                if kind == "predict":
+                    requests.append((connection, payload))
+                else:
+                    results.append(payload)
+                    open_connections.remove(connection)
+
+            if not requests:
+                continue
+
+            pis, vs = self.net.predict_batch(
+                *merge_requests([request for _, request in requests]))
+
+            start = 0
+            for connection, (states, _, _) in requests:
+                end = start + len(states)
+                connection.send((pis[start:end], vs[start:end]))
+                start = end
+
+        return results
+
+
+class AsyncEvaluator(object):
+    """Evaluates the states of concurrent self-play coroutines in batches.
+
+    The games of one process run as asyncio coroutines which await evaluate
+    for their leaves. A batch is run through the network once it holds
+    max_batch_size states, once every running game is waiting, or once
+    the oldest request has waited timeout seconds.
+
+    Attributes:
+        net: A NeuralNetworkWrapper used for the forward passes.
+        max_batch_size: An integer for the maximum states per forward pass.
+        timeout: A float for the seconds a request waits for a fuller batch.
+        requests: A list of the pending (states, keys, valid_moves)
+            requests and their futures.
+        num_states: An integer for the number of pending states.
+        running: An integer for the number of games not yet finished.
+        wakeup: An asyncio event set on every new request or finished game.
+    """
+
+    def __init__(self, net, max_batch_size, timeout):
+        """Initializes AsyncEvaluator with the network and batch limits."""
+        self.net = net
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.requests = []
+        self.num_states = 0
+        self.running = 0
+        self.wakeup = None
+
+    async def run(self, coroutines):
+        """Runs the game coroutines while serving their evaluations.
+
+        Args:
+            coroutines: A list of coroutines awaiting evaluate.
+
+        Returns:
+            A list of the results of the coroutines.
+        """
+        self.wakeup = asyncio.Event()
+        self.running = len(coroutines)
+        server = asyncio.ensure_future(self.serve())
+        try:
+            return await asyncio.gather(
+                *[self.track(coroutine) for coroutine in coroutines])
+        finally:
+            await server
+
+    async def track(self, coroutine):
+        """Awaits a game coroutine and counts it as finished afterwards."""
+        try:
+            return await coroutine
+        finally:
+            self.running -= 1
+            self.wakeup.set()
+
+    async def evaluate(self, states, keys=None, valid_moves=None):
+        """Predicts move probabilities and state values for several states.
+
+        Args:
+            states: An array of game states in matrix form, shaped
+                (N, row, column).
+            keys: An optional sequence of N position hashes for the
+                network's cache.
+            valid_moves: An optional (N, action_size) array of the valid
+                moves to restrict the probabilities to.
+
+        Returns:
+            An (N, action_size) array of probability vectors and an (N,)
+            array of values.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.requests.append(((states, keys, valid_moves), future))
+        self.num_states += len(states)
+        self.wakeup.set()
+
+        return await future
+
+    async def serve(self):
+        """Runs batches of the pending requests until all games finished."""
+        loop = asyncio.get_running_loop()
+
+        while self.running > 0 or self.requests:
+            if not self.requests:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            # Wait for a fuller batch while some game is still searching.
+            deadline = loop.time() + self.timeout
+            while (self.num_states < self.max_batch_size and
+                   len(self.requests) < self.running):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            # Take whole requests up to max_batch_size states, at least one.
+            count = 1
+            size = len(self.requests[0][0][0])
+            while (count < len(self.requests) and size + len(
+                    self.requests[count][0][0]) <= self.max_batch_size):
+                size += len(self.requests[count][0][0])
+                count += 1
+            requests = self.requests[:count]
+            del self.requests[:count]
+            self.num_states -= size
+
+            try:
+                pis, vs = self.net.predict_batch(*merge_requests(
+                    [request for request, _ in requests]))
+            except Exception as error:
+                # Fail the waiting games instead of leaving them hanging.
+                for _, future in requests:
+                    future.set_exception(error)
+                continue
+
+            start = 0
+            for request, future in requests:
+                end = start + len(request[0])
+                future.set_result((pis[start:end], vs[start:end]))
+                start = end
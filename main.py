@@ -174,6 +174,139 @@ parser.add_argument("--loss_file",
                     type=str,
                     default=CFG.loss_file)
 
+parser.add_argument("--move_generator",
+                    help="Blokus move generation backend.",
+                    dest="move_generator",
+                    type=str,
+                    choices=["table", "bitboard", "vectorized",
+                             "incremental"],
+                    default=CFG.move_generator)
+
+parser.add_argument("--fpu_value",
+                    help="Q value assumed for unvisited children in MCTS.",
+                    dest="fpu_value",
+                    type=float,
+                    default=CFG.fpu_value)
+
+parser.add_argument("--tie_break",
+                    help="How MCTS selection resolves equal Q + U values.",
+                    dest="tie_break",
+                    type=str,
+                    choices=["first", "random"],
+                    default=CFG.tie_break)
+
+parser.add_argument("--mcts_batch_size",
+                    help="Number of MCTS leaves evaluated in one network call.",
+                    dest="mcts_batch_size",
+                    type=int,
+                    default=CFG.mcts_batch_size)
+
+parser.add_argument("--virtual_loss",
+                    help="Virtual loss applied to paths awaiting evaluation.",
+                    dest="virtual_loss",
+                    type=float,
+                    default=CFG.virtual_loss)
+
+parser.add_argument("--num_workers",
+                    help="Number of parallel self-play processes.",
+                    dest="num_workers",
+                    type=int,
+                    default=CFG.num_workers)
+
+parser.add_argument("--validate_state",
+                    help="Binary to check that undo restores the exact game "
+                         "state and that the incremental hash and feature "
+                         "planes match a recomputation.",
+                    dest="validate_state",
+                    type=int,
+                    default=CFG.validate_state)
+
+parser.add_argument("--async_games",
+                    help="Number of self play games played at once per process.",
+                    dest="async_games",
+                    type=int,
+                    default=CFG.async_games)
+
+parser.add_argument("--eval_batch_size",
+                    help="Maximum states in one batch of the asyncio games.",
+                    dest="eval_batch_size",
+                    type=int,
+                    default=CFG.eval_batch_size)
+
+parser.add_argument("--eval_timeout",
+                    help="Seconds a leaf waits for a fuller batch.",
+                    dest="eval_timeout",
+                    type=float,
+                    default=CFG.eval_timeout)
+
+parser.add_argument("--eval_cache_size",
+                    help="Maximum network predictions cached, 0 to disable.",
+                    dest="eval_cache_size",
+                    type=int,
+                    default=CFG.eval_cache_size)
+
+parser.add_argument("--eval_cache_memory",
+                    help="Maximum megabytes of cached network predictions.",
+                    dest="eval_cache_memory",
+                    type=int,
+                    default=CFG.eval_cache_memory)
+
+parser.add_argument("--transpositions",
+                    help="Binary to share MCTS nodes between transpositions.",
+                    dest="transpositions",
+                    type=int,
+                    default=CFG.transpositions)
+
+parser.add_argument("--sparse_policy",
+                    help="Binary to compute the policy only at valid moves.",
+                    dest="sparse_policy",
+                    type=int,
+                    default=CFG.sparse_policy)
+
+parser.add_argument("--policy_head",
+                    help="Network policy head.",
+                    dest="policy_head",
+                    type=str,
+                    choices=["dense", "conv"],
+                    default=CFG.policy_head)
+
+parser.add_argument("--input_features",
+                    help="Binary to feed the network feature planes.",
+                    dest="input_features",
+                    type=int,
+                    default=CFG.input_features)
+
+parser.add_argument("--full_search_prob",
+                    help="Probability of a full, recorded self play search.",
+                    dest="full_search_prob",
+                    type=float,
+                    default=CFG.full_search_prob)
+
+parser.add_argument("--fast_mcts_sims",
+                    help="Number of MCTS simulations of fast searches.",
+                    dest="fast_mcts_sims",
+                    type=int,
+                    default=CFG.fast_mcts_sims)
+
+parser.add_argument("--early_stop",
+                    help="Binary to stop searches whose best move is settled.",
+                    dest="early_stop",
+                    type=int,
+                    default=CFG.early_stop)
+
+parser.add_argument("--search_time_ms",
+                    help="Time limit of a search in milliseconds, 0 for none.",
+                    dest="search_time_ms",
+                    type=float,
+                    default=CFG.search_time_ms)
+
+parser.add_argument("--move_time_ms",
+                    help="Thinking time per move against a human in "
+                         "milliseconds, 0 for a fixed simulation count.",
+                    dest="move_time_ms",
+                    type=float,
+                    default=CFG.move_time_ms)
+
 # parser.add_argument("--game",
 #                     help="Name of the file to record loss.",
 #                     dest="game",
@@ -208,6 +341,27 @@ if __name__ == '__main__':
     CFG.resnet_blocks = arguments.resnet_blocks
     CFG.record_loss = arguments.record_loss
     CFG.loss_file = arguments.loss_file
+    CFG.move_generator = arguments.move_generator
+    CFG.fpu_value = arguments.fpu_value
+    CFG.tie_break = arguments.tie_break
+    CFG.mcts_batch_size = arguments.mcts_batch_size
+    CFG.virtual_loss = arguments.virtual_loss
+    CFG.num_workers = arguments.num_workers
+    CFG.validate_state = arguments.validate_state
+    CFG.async_games = arguments.async_games
+    CFG.eval_batch_size = arguments.eval_batch_size
+    CFG.eval_timeout = arguments.eval_timeout
+    CFG.eval_cache_size = arguments.eval_cache_size
+    CFG.eval_cache_memory = arguments.eval_cache_memory
+    CFG.transpositions = arguments.transpositions
+    CFG.sparse_policy = arguments.sparse_policy
+    CFG.policy_head = arguments.policy_head
+    CFG.input_features = arguments.input_features
+    CFG.full_search_prob = arguments.full_search_prob
+    CFG.fast_mcts_sims = arguments.fast_mcts_sims
+    CFG.early_stop = arguments.early_stop
+    CFG.search_time_ms = arguments.search_time_ms
+    CFG.move_time_ms = arguments.move_time_ms
     # CFG.game = arguments.game
 
     game = BlokusGame()
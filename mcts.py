@@ -22,110 +22,383 @@
 # ==============================================================================
 """Classes for Monte Carlo Tree Search."""
 import math
+import time
+from collections import Counter, namedtuple
 
 import numpy as np
 
 from config import CFG
-from copy import deepcopy
 
+# A leaf waiting for its network evaluation: the node, the edges walked from
+# the root, the network input, its position hash, the valid moves, whether
+# the game is over there and its outcome.
+Leaf = namedtuple("Leaf", ["node", "path", "state", "key", "valid_moves",
+                           "game_over", "wsa"])
 
-class TreeNode(object):
-    """Represents a board state and stores statistics for actions at that state.
+# The action number of a pass edge. A position where the player to move has
+# no valid move but the game goes on gets a single pass edge.
+PASS = -1
+
+
+def run_steps(steps, predict_batch):
+    """Runs a search generator, evaluating its states with predict_batch.
+
+    Search generators yield (states, keys, valid_moves) requests, an array of
+    game states with their position hashes and valid moves, and receive the
+    network's move probabilities, restricted to the valid moves, and values
+    for them. This way the same search can be driven by a
+    network, an InferenceServer or an AsyncEvaluator.
+
+    Args:
+        steps: A generator yielding (states, keys, valid_moves) requests.
+        predict_batch: A function mapping states, keys and valid moves to an
+            array of probability vectors and an array of values.
+
+    Returns:
+        The value returned by the generator.
+    """
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(predict_batch(*request))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_steps_async(steps, evaluate):
+    """Runs a search generator, awaiting the evaluations of its states.
+
+    Args:
+        steps: A generator yielding (states, keys, valid_moves) requests.
+        evaluate: A coroutine function mapping states, keys and valid moves
+            to an array of probability vectors and an array of values.
+
+    Returns:
+        The value returned by the generator.
+    """
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(await evaluate(*request))
+    except StopIteration as stop:
+        return stop.value
+
+
+def grow(array, size):
+    """Returns a copy of array enlarged to at least size entries.
+
+    The capacity at least doubles so that repeated growth stays amortized.
+
+    Args:
+        array: A NumPy array.
+        size: An integer for the minimum number of entries needed.
+
+    Returns:
+        A zero padded NumPy array of the same dtype.
+    """
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class SearchTree(object):
+    """Stores a whole search tree as contiguous NumPy arrays.
+
+    Nodes are board states and edges are the moves leaving them. The edges of
+    a node are stored next to each other, so a node only keeps the offset and
+    count of its children and selection and backup are index arithmetic.
+
+    With CFG.transpositions set, the tree is a DAG: nodes are looked up by
+    position hash, so a position reached by several move orders is one node
+    shared by all the edges leading to it. Its visits and values are then
+    aggregated over every path, and selection values an edge by the node it
+    leads to. Blokus positions cannot repeat, so the graph has no cycles.
 
     Attributes:
-        Nsa: An integer for visit count.
-        Wsa: A float for the total action value.
-        Qsa: A float for the mean action value.
-        Psa: A float for the prior probability of reaching this node.
-        action: A tuple(row, column) of the prior move of reaching this node.
-        children: A list which stores child nodes.
-        child_psas: A vector containing child probabilities.
-        parent: A TreeNode representing the parent node.
+        node_first: Per node, the index of its first child edge.
+        node_count: Per node, the number of child edges.
+        node_N: Per node, the visit count.
+        node_W: Per node, the total value for the player who moved into it.
+        edge_N: Per edge, the visit count.
+        edge_W: Per edge, the total action value.
+        edge_Q: Per edge, the mean action value.
+        edge_P: Per edge, the prior probability of the move.
+        edge_action: Per edge, the action number of the move, PASS for a
+            pass.
+        edge_child: Per edge, the node it leads to, -1 until it is visited.
+        num_nodes: An integer for the number of nodes in use.
+        num_edges: An integer for the number of edges in use.
+        node_table: A dict mapping position hashes to nodes in DAG mode,
+            None otherwise.
     """
 
-    def __init__(self, parent=None, action=None, psa=0.0, child_psas=[]):
-        """Initializes TreeNode with the initial statistics and data."""
-        self.Nsa = 0
-        self.Wsa = 0.0
-        self.Qsa = 0.0
-        self.Psa = psa
-        self.action = action
-        self.children = []
-        self.child_psas = child_psas
-        self.parent = parent
+    def __init__(self, node_capacity=256, edge_capacity=4096):
+        """Initializes SearchTree with empty arrays and a root node 0."""
+        self.node_first = np.zeros(node_capacity, dtype=np.int64)
+        self.node_count = np.zeros(node_capacity, dtype=np.int64)
+        self.node_N = np.zeros(node_capacity, dtype=np.int64)
+        self.node_W = np.zeros(node_capacity)
+        self.edge_N = np.zeros(edge_capacity, dtype=np.int64)
+        self.edge_W = np.zeros(edge_capacity)
+        self.edge_Q = np.zeros(edge_capacity)
+        self.edge_P = np.zeros(edge_capacity)
+        self.edge_action = np.zeros(edge_capacity, dtype=np.int64)
+        self.edge_child = np.zeros(edge_capacity, dtype=np.int64)
+        self.num_nodes = 0
+        self.num_edges = 0
+        self.node_table = {} if CFG.transpositions else None
+        self.add_node()
+
+    def add_node(self):
+        """Allocates an unexpanded node.
+
+        Returns:
+            The index of the new node.
+        """
+        if self.num_nodes == len(self.node_N):
+            for name in ["node_first", "node_count", "node_N", "node_W"]:
+                setattr(self, name, grow(getattr(self, name), self.num_nodes + 1))
+
+        index = self.num_nodes
+        self.node_first[index] = 0
+        self.node_count[index] = 0
+        self.node_N[index] = 0
+        self.node_W[index] = 0.0
+        self.num_nodes += 1
+        return index
+
+    def register(self, node, key):
+        """Records the position hash of a node in DAG mode.
+
+        Args:
+            node: An integer index of the node.
+            key: An integer hash of the node's position.
+        """
+        if self.node_table is not None:
+            self.node_table.setdefault(key, node)
+
+    def is_not_leaf(self, node):
+        """Checks if a node has children.
 
-    def is_not_leaf(self):
-        """Checks if a TreeNode is a leaf.
+        Args:
+            node: An integer index of the node.
 
         Returns:
-            A boolean value indicating if a TreeNode is a leaf.
+            A boolean value indicating if the node has been expanded with
+            at least one child.
         """
-        if len(self.children) > 0:
-            return True
-        return False
+        return self.node_count[node] > 0
+
+    def child(self, edge, key=None):
+        """Returns the node an edge leads to, allocating it on first use.
 
-    def select_child(self):
-        """Selects a child node based on the AlphaZero PUCT formula.
+        In DAG mode an existing node of the same position is linked instead
+        of allocating a new one.
+
+        Args:
+            edge: An integer index of the edge.
+            key: An optional integer hash of the position the edge leads to.
 
         Returns:
-            A child TreeNode which is the most promising according to PUCT.
+            An integer index of the child node.
         """
-        c_puct = CFG.c_puct
+        if self.edge_child[edge] < 0:
+            if self.node_table is not None and key is not None:
+                if key not in self.node_table:
+                    self.node_table[key] = self.add_node()
+                self.edge_child[edge] = self.node_table[key]
+            else:
+                self.edge_child[edge] = self.add_node()
+        return self.edge_child[edge]
+
+    def select_child(self, node):
+        """Selects a child edge based on the AlphaZero PUCT formula.
+
+        Unvisited children are valued at CFG.fpu_value (first-play urgency).
+        Children tied for the highest Q + U are resolved by CFG.tie_break:
+        "first" takes the lowest action number, "random" picks uniformly.
 
-        highest_uct = 0
-        highest_index = 0
+        Args:
+            node: An integer index of the node.
+
+        Returns:
+            The index of the edge which is the most promising according to
+            PUCT.
+        """
+        first = self.node_first[node]
+        last = first + self.node_count[node]
+        nsa = self.edge_N[first:last]
+
+        if self.node_table is None:
+            qsa = np.where(nsa > 0, self.edge_Q[first:last], CFG.fpu_value)
+        else:
+            # Value shared nodes by all their visits, not only this edge's.
+            children = self.edge_child[first:last]
+            visits = np.where(children >= 0, self.node_N[children], 0)
+            qsa = np.where(visits > 0,
+                           self.node_W[children] / np.maximum(visits, 1),
+                           CFG.fpu_value)
 
         # Select the child with the highest Q + U value
-        for idx, child in enumerate(self.children):
-            uct = child.Qsa + child.Psa * c_puct * (
-                    math.sqrt(self.Nsa) / (1 + child.Nsa))
-            if uct > highest_uct:
-                highest_uct = uct
-                highest_index = idx
+        uct = qsa + self.edge_P[first:last] * CFG.c_puct * (
+                math.sqrt(self.node_N[node]) / (1 + nsa))
 
-        return self.children[highest_index]
+        if CFG.tie_break == "random":
+            return first + int(np.random.choice(np.flatnonzero(uct == uct.max())))
+        return first + int(np.argmax(uct))
 
-    def expand_node(self, game, psa_vector):
-        """Expands the current node by adding valid moves as children.
+    def expand_node(self, node, actions, psas):
+        """Expands a node by adding one child edge per valid move.
 
         Args:
-            game: An object containing the game state.
-            psa_vector: A list containing move probabilities for each move.
+            node: An integer index of the node.
+            actions: An array of the valid action numbers.
+            psas: An array of the move probabilities of those actions.
+        """
+        first = self.num_edges
+        last = first + len(actions)
+        if last > len(self.edge_N):
+            for name in ["edge_N", "edge_W", "edge_Q", "edge_P",
+                         "edge_action", "edge_child"]:
+                setattr(self, name, grow(getattr(self, name), last))
+
+        self.edge_N[first:last] = 0
+        self.edge_W[first:last] = 0.0
+        self.edge_Q[first:last] = 0.0
+        self.edge_P[first:last] = psas
+        self.edge_action[first:last] = actions
+        self.edge_child[first:last] = -1
+
+        self.node_first[node] = first
+        self.node_count[node] = last - first
+        self.num_edges = last
+
+    def back_prop(self, root, path, wsa, v):
+        """Updates the statistics along a path based on the game outcome.
+
+        Args:
+            root: An integer index of the node the path starts from.
+            path: A list of the edge indices from the root to the leaf.
+            wsa: A float representing the action value for the leaf state.
+            v: A float representing the network value of the leaf state.
         """
-        self.child_psas = deepcopy(psa_vector)
-        valid_moves = game.get_valid_moves(game.current_player)
-        for idx, move in enumerate(valid_moves):
-            if move == 1:
-                action = idx
-                self.add_child_node(parent=self, action=action,
-                                    psa=psa_vector[idx])
+        for edge in reversed(path):
+            wsa = -wsa
+            v = -v
+            self.edge_N[edge] += 1
+            self.edge_W[edge] += wsa + v
+            self.edge_Q[edge] = self.edge_W[edge] / self.edge_N[edge]
+            self.node_N[self.edge_child[edge]] += 1
+            self.node_W[self.edge_child[edge]] += wsa + v
+
+        self.node_N[root] += 1
 
-    def add_child_node(self, parent, action, psa=0.0):
-        """Creates and adds a child TreeNode to the current node.
+    def add_virtual_loss(self, root, path):
+        """Counts a pending evaluation along a path as a lost visit.
+
+        This steers the next selections of the same batch towards other
+        leaves.
 
         Args:
-            parent: A TreeNode which is the parent of this node.
-            action: A tuple(row, column) of the prior move to reach this node.
-            psa: A float representing the raw move probability for this node.
+            root: An integer index of the node the path starts from.
+            path: A list of the edge indices from the root to the leaf.
+        """
+        for edge in path:
+            self.edge_N[edge] += 1
+            self.edge_W[edge] -= CFG.virtual_loss
+            self.edge_Q[edge] = self.edge_W[edge] / self.edge_N[edge]
+            self.node_N[self.edge_child[edge]] += 1
+            self.node_W[self.edge_child[edge]] -= CFG.virtual_loss
 
-        Returns:
-            The newly created child TreeNode.
+        self.node_N[root] += 1
+
+    def revert_virtual_loss(self, root, path):
+        """Removes the virtual loss added by add_virtual_loss.
+
+        Args:
+            root: An integer index of the node the path starts from.
+            path: A list of the edge indices from the root to the leaf.
         """
+        for edge in path:
+            self.edge_N[edge] -= 1
+            self.edge_W[edge] += CFG.virtual_loss
+            if self.edge_N[edge] > 0:
+                self.edge_Q[edge] = self.edge_W[edge] / self.edge_N[edge]
+            else:
+                self.edge_Q[edge] = 0.0
+            self.node_N[self.edge_child[edge]] -= 1
+            self.node_W[self.edge_child[edge]] += CFG.virtual_loss
 
-        child_node = TreeNode(parent=parent, action=action, psa=psa)
-        self.children.append(child_node)
-        return child_node
+        self.node_N[root] -= 1
 
-    def back_prop(self, wsa, v):
-        """Update the current node's statistics based on the game outcome.
+    def subtree(self, node):
+        """Copies a node and everything reachable from it into a new tree.
+
+        Used to keep the searched subtree of the move played while freeing
+        the rest of the tree. Edges keep their order and statistics.
 
         Args:
-            wsa: A float representing the action value for this state.
-            v: A float representing the network value of this state.
+            node: An integer index of the node to become the new root 0.
+
+        Returns:
+            A new SearchTree.
         """
-        self.Nsa += 1
-        self.Wsa = wsa + v
-        self.Qsa = self.Wsa / self.Nsa
+        # Number the reachable nodes in breadth first order.
+        order = [node]
+        remap = np.full(self.num_nodes, -1, dtype=np.int64)
+        remap[node] = 0
+        for old in order:
+            first = self.node_first[old]
+            children = self.edge_child[first:first + self.node_count[old]]
+            for child in children[children >= 0]:
+                if remap[child] < 0:
+                    remap[child] = len(order)
+                    order.append(child)
+
+        order = np.array(order)
+        counts = self.node_count[order]
+        edges = np.concatenate(
+            [np.arange(self.node_first[old], self.node_first[old] + count)
+             for old, count in zip(order, counts)]).astype(np.int64)
+
+        tree = SearchTree(node_capacity=1, edge_capacity=1)
+        tree.node_first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        tree.node_count = counts
+        tree.node_N = self.node_N[order]
+        tree.node_W = self.node_W[order]
+        tree.edge_N = self.edge_N[edges]
+        tree.edge_W = self.edge_W[edges]
+        tree.edge_Q = self.edge_Q[edges]
+        tree.edge_P = self.edge_P[edges]
+        tree.edge_action = self.edge_action[edges]
+        children = self.edge_child[edges]
+        tree.edge_child = np.where(children >= 0, remap[children], -1)
+        tree.num_nodes = len(order)
+        tree.num_edges = len(edges)
+        if self.node_table is not None:
+            tree.node_table = {key: int(remap[index]) for key, index
+                               in self.node_table.items() if remap[index] >= 0}
+
+        return tree
+
+
+class TreeNode(object):
+    """Refers to one node of a SearchTree.
+
+    Used to hand search roots and chosen moves between MonteCarloTreeSearch
+    and its callers, so that the subtree can be reused for the next move.
+
+    Attributes:
+        tree: A SearchTree holding the statistics.
+        index: An integer index of the node in the tree.
+        action: The action number of the move leading to this node.
+    """
+
+    def __init__(self, tree=None, index=0, action=None):
+        """Initializes TreeNode, by default as the root of a new tree."""
+        self.tree = tree if tree is not None else SearchTree()
+        self.index = index
+        self.action = action
 
 
 class MonteCarloTreeSearch(object):
@@ -135,6 +408,10 @@ class MonteCarloTreeSearch(object):
         root: A TreeNode representing the board state and its statistics.
         game: An object containing the game state.
         net: An object containing the neural network.
+        reused_visits: An integer counting the visits carried over to new
+            roots by advance.
+        stats: A Counter of the searches by the reason they stopped, see
+            stop_reason, and of the "simulations" they ran.
     """
 
     def __init__(self, net):
@@ -142,115 +419,355 @@ class MonteCarloTreeSearch(object):
         self.root = None
         self.game = None
         self.net = net
+        self.reused_visits = 0
+        self.stats = Counter()
+
+    def advance(self, node, action, game):
+        """Moves the search root past a move, reusing what was searched.
 
-    def search(self, game, node, temperature):
+        Works for any move, whether chosen by the search or not, and for
+        passes. The subtree of the new root is copied into a compact tree
+        and the rest of the old tree is freed.
+
+        Args:
+            node: The TreeNode searched for the position before the move.
+            action: The action number played, or None for a pass.
+            game: An object containing the game state after the move.
+
+        Returns:
+            A TreeNode for the position after the move, a new tree if the
+            position was not searched before.
+        """
+        tree = node.tree
+        if action is None:
+            action = PASS
+        child = -1
+        first = tree.node_first[node.index]
+        actions = tree.edge_action[first:first + tree.node_count[node.index]]
+        edges = np.flatnonzero(actions == action)
+        if len(edges) > 0:
+            child = tree.edge_child[first + edges[0]]
+
+        # DAG mode may know the position from another move order.
+        if child < 0 and tree.node_table is not None:
+            child = tree.node_table.get(game.hash, -1)
+
+        if child < 0:
+            return TreeNode()
+
+        self.reused_visits += int(tree.node_N[child])
+        return TreeNode(tree.subtree(child), 0,
+                        None if action == PASS else action)
+
+    def search(self, game, node, temperature, num_sims=None, add_noise=True):
         """MCTS loop to get the best move which can be played at a given state.
 
         Args:
             game: An object containing the game state.
             node: A TreeNode representing the board state and its statistics.
             temperature: A float to control the level of exploration.
+            num_sims: An integer for the simulation budget, by default
+                CFG.num_mcts_sims.
+            add_noise: A bool to add Dirichlet noise at the root.
+
+        Returns:
+            A child node representing the best move to play at this state.
+        """
+        return run_steps(self.search_steps(game, node, temperature, num_sims,
+                                           add_noise),
+                         self.net.predict_batch)
+
+    async def search_async(self, game, node, temperature, evaluator,
+                           num_sims=None, add_noise=True):
+        """Coroutine version of search awaiting the evaluator for its leaves.
+
+        Args:
+            game: An object containing the game state.
+            node: A TreeNode representing the board state and its statistics.
+            temperature: A float to control the level of exploration.
+            evaluator: An AsyncEvaluator batching the leaves of many games.
+            num_sims: An integer for the simulation budget, by default
+                CFG.num_mcts_sims.
+            add_noise: A bool to add Dirichlet noise at the root.
+
+        Returns:
+            A child node representing the best move to play at this state.
+        """
+        return await run_steps_async(
+            self.search_steps(game, node, temperature, num_sims, add_noise),
+            evaluator.evaluate)
+
+    def search_for(self, game, node, time_budget_ms):
+        """Searches until a deadline and returns the move to play.
+
+        Unlike search, the number of simulations is not fixed: batches of
+        CFG.mcts_batch_size leaves are evaluated until time_budget_ms has
+        passed, so the time per move is about the same in every position.
+        No Dirichlet noise is added and the most visited move is chosen.
+
+        Args:
+            game: An object containing the game state.
+            node: A TreeNode representing the board state and its statistics.
+            time_budget_ms: A float for the milliseconds the search may take.
+
+        Returns:
+            A child node representing the best move, None when there is no
+            valid move, and a dict of the search statistics: the number of
+            "simulations" run, the "elapsed_ms" and, per searched move from
+            the most visited on, its "actions" (PASS for a pass), "visits"
+            and mean action value "q".
+        """
+        start = time.time()
+        simulations = self.stats["simulations"]
+        best_child, _ = run_steps(
+            self.search_steps(game, node, 0, float("inf"), False,
+                              start + time_budget_ms / 1000.0),
+            self.net.predict_batch)
+
+        tree = node.tree
+        first = tree.node_first[node.index]
+        last = first + tree.node_count[node.index]
+        order = first + np.argsort(-tree.edge_N[first:last], kind="stable")
+        return best_child, {
+            "simulations": self.stats["simulations"] - simulations,
+            "elapsed_ms": (time.time() - start) * 1000.0,
+            "actions": tree.edge_action[order],
+            "visits": tree.edge_N[order],
+            "q": tree.edge_Q[order]}
+
+    def search_steps(self, game, node, temperature, num_sims=None,
+                     add_noise=True, deadline=None):
+        """Generator running the MCTS loop of search.
+
+        Yields the states, position hashes and valid moves of each batch of
+        leaves and expects to be sent the move probabilities and values of
+        the network for them.
+
+        Args:
+            game: An object containing the game state.
+            node: A TreeNode representing the board state and its statistics.
+            temperature: A float to control the level of exploration.
+            num_sims: An integer for the simulation budget, by default
+                CFG.num_mcts_sims.
+            add_noise: A bool to add Dirichlet noise at the root.
+            deadline: A time.time() value to stop at, by default
+                CFG.search_time_ms from now if that is set.
 
         Returns:
             A child node representing the best move to play at this state.
         """
         self.root = node
         self.game = game
+        tree = node.tree
+        root = node.index
+        tree.register(root, game.hash)
+        if num_sims is None:
+            num_sims = CFG.num_mcts_sims
+
+        if deadline is None and CFG.search_time_ms > 0:
+            deadline = time.time() + CFG.search_time_ms / 1000.0
+
+        # A reused root is already expanded, so its noise is mixed in here.
+        # The clean priors are put back after the search.
+        clean_priors = None
+        if add_noise and tree.is_not_leaf(root):
+            first = tree.node_first[root]
+            last = first + tree.node_count[root]
+            clean_priors = tree.edge_P[first:last].copy()
+            tree.edge_P[first:last] = self.add_dirichlet_noise(clean_priors)
+
+        # Visits of a reused root count towards the simulation budget.
+        simulations = int(tree.node_N[root])
+        reason = "budget"
+        while simulations < num_sims:
+            stop = self.stop_reason(tree, root, num_sims - simulations,
+                                    deadline)
+            if stop is not None:
+                reason = stop
+                break
+
+            leaves, collisions = self.collect_leaves(tree, root, min(
+                CFG.mcts_batch_size, num_sims - simulations))
+
+            # Get move probabilities and values from the network for all
+            # the leaves in one batch.
+            # The network restricts the probabilities to the valid moves
+            # and renormalizes them.
+            psa_vectors, vs = yield (
+                np.array([leaf.state for leaf in leaves]),
+                [leaf.key for leaf in leaves],
+                np.array([leaf.valid_moves for leaf in leaves]))
+
+            for leaf, psa_vector, v in zip(leaves, psa_vectors, vs):
+                tree.revert_virtual_loss(root, leaf.path)
+
+                actions = np.flatnonzero(leaf.valid_moves)
+                if len(actions) == 0 and not leaf.game_over:
+                    # The player has to pass, the search goes on past it.
+                    actions = np.array([PASS])
+                    psas = np.ones(1)
+                elif CFG.sparse_policy:
+                    psas = psa_vector  # Already only the valid actions.
+                else:
+                    psas = psa_vector[actions]
+
+                # Add Dirichlet noise to the psas of the root node.
+                if not leaf.path and add_noise:
+                    clean_priors = psas
+                    psas = self.add_dirichlet_noise(psas)
+
+                # Try expanding the current node.
+                tree.expand_node(leaf.node, actions, psas)
+                tree.back_prop(root, leaf.path, leaf.wsa, v)
+
+            for path in collisions:
+                tree.revert_virtual_loss(root, path)
+
+            simulations += len(leaves)
+            self.stats["simulations"] += len(leaves)
+
+        self.stats[reason] += 1
 
-        for i in range(CFG.num_mcts_sims):
-            # print('SIMULATION N ', i)
-            node = self.root
-            temp_game = deepcopy(self.game)  # Create a fresh clone for each loop.
-
-            # Loop when node is not a leaf
-            while node.is_not_leaf():
-                node = node.select_child()
-                temp_game.play_action(node.action)
-                
-            # Get move probabilities and values from the network for this state.
-            psa_vector, v = self.net.predict(temp_game.state)
-
-            # Add Dirichlet noise to the psa_vector of the root node.
-            if node.parent is None:
-                psa_vector = self.add_dirichlet_noise(temp_game, psa_vector)
-
-            
-            valid_moves = temp_game.get_valid_moves(temp_game.current_player)
-            for idx, move in enumerate(valid_moves):
-                if move == 0:
-                    psa_vector[idx] = 0
-
-            psa_vector_sum = sum(psa_vector)
-
-            # Renormalize psa vector
-            if psa_vector_sum > 0:
-                psa_vector /= psa_vector_sum
-
-            # Try expanding the current node.
-            node.expand_node(game=temp_game, psa_vector=psa_vector)
-            game_over, wsa = temp_game.check_game_over(temp_game.current_player)
-            while node is not None:
-                wsa = -wsa
-                v = -v
-                node.back_prop(wsa, v)
-                node = node.parent
-
-        highest_nsa = 0
-        highest_index = 0
-        highest_child = 0
         # Select the child's move using a temperature parameter.
-        probvector = np.zeros(len(psa_vector))    
-        s = 0
-        # temperature_exponent = int(1 / temperature)
-        
-        if temperature == 1:
-            for idx, child in enumerate(self.root.children):
-                # print(idx, child.Nsa)
-                s += child.Nsa
-                probvector[child.action] = child.Nsa
-                if child.Nsa > highest_nsa:
-                    highest_nsa = child.Nsa
-                    # highest_index = child.action
-                    highest_child = idx
-            probvector /= s
-        
-        else:
-            for idx, child in enumerate(self.root.children):
-                if child.Nsa > highest_nsa:
-                    probvector[highest_index] = 0
-                    highest_nsa = child.Nsa
-                    highest_index = child.action
-                    probvector[highest_index] = 1
-                    highest_child = idx
-
-        if len(self.root.children) > 0:
-            # print(s, self.root.Nsa, len(self.root.children))
-            # print(probvector[np.nonzero(probvector)])
-            # print(self.root.child_psas[np.nonzero(self.root.child_psas)])
-            # print(np.nonzero(probvector) == np.nonzero(self.root.child_psas))
-            return self.root.children[highest_child], probvector
-        else:
+        first = tree.node_first[root]
+        last = first + tree.node_count[root]
+        child_nsas = tree.edge_N[first:last]
+        child_actions = tree.edge_action[first:last]
+        probvector = np.zeros(game.action_size)
+
+        if clean_priors is not None:
+            tree.edge_P[first:last] = clean_priors
+
+        # No move, or only a pass.
+        if last == first or child_actions[0] == PASS:
             return None, probvector
 
-    def add_dirichlet_noise(self, game, psa_vector):
-        """Add Dirichlet noise to the psa_vector of the root node.
+        highest_child = int(np.argmax(child_nsas))
+        if temperature == 1:
+            probvector[child_actions] = child_nsas
+            if child_nsas.sum() > 0:
+                probvector /= child_nsas.sum()
+        elif child_nsas[highest_child] > 0:
+            probvector[child_actions[highest_child]] = 1
+
+        best_edge = first + highest_child
+        return TreeNode(tree, tree.child(best_edge),
+                        int(tree.edge_action[best_edge])), probvector
+
+    def stop_reason(self, tree, root, remaining, deadline):
+        """Checks if a search can stop before using its whole budget.
+
+        A search never stops before its root is expanded. After that, it
+        stops at its deadline or when the root has no valid move, so that
+        the game is over or the player has to pass. With
+        CFG.early_stop, it also stops once the root has a single valid
+        move, or once the most visited move leads the runner-up by more
+        visits than the remaining budget.
 
-        This is for additional exploration.
+        Args:
+            tree: The SearchTree being searched.
+            root: An integer index of the root node.
+            remaining: An integer for the simulations left in the budget.
+            deadline: A time.time() value to stop at, or None.
+
+        Returns:
+            "time", "no_move", "single_move" or "unassailable", or None to
+            go on searching.
+        """
+        if tree.node_N[root] == 0:
+            return None
+        if deadline is not None and time.time() >= deadline:
+            return "time"
+
+        first = tree.node_first[root]
+        nsa = tree.edge_N[first:first + tree.node_count[root]]
+        if len(nsa) == 0 or tree.edge_action[first] == PASS:
+            return "no_move"
+        if not CFG.early_stop:
+            return None
+        if len(nsa) == 1:
+            return "single_move"
+
+        runner_up, leader = np.partition(nsa, -2)[-2:]
+        if leader - runner_up > remaining:
+            return "unassailable"
+        return None
+
+    def collect_leaves(self, tree, root, count):
+        """Selects up to count distinct leaves for one batched evaluation.
+
+        Each of the count walks plays its moves on the shared game, records
+        the leaf and undoes the moves again. Virtual loss along the walked
+        path makes the following walks diverge. A walk ending on a leaf
+        that is already waiting for its evaluation is a collision: it keeps
+        its virtual loss until the batch is backed up, but is not evaluated
+        nor counted as a simulation.
 
         Args:
-            game: An object containing the game state.
-            psa_vector: A probability vector.
+            tree: The SearchTree being searched.
+            root: An integer index of the root node.
+            count: An integer for the maximum number of leaves.
 
         Returns:
-            A probability vector which has Dirichlet noise added to it.
+            A non empty list of Leaf tuples, and a list of the paths of the
+            collisions.
         """
-        dirichlet_input = [CFG.dirichlet_alpha for x in range(game.action_size)]
+        game = self.game
+        leaves = []
+        collisions = []
+        pending = set()
 
-        dirichlet_list = np.random.dirichlet(dirichlet_input)
-        noisy_psa_vector = []
+        for i in range(count):
+            leaf = root
+            path = []  # Edges walked from the root.
+            undo_records = []
+
+            # Loop when node is not a leaf
+            while tree.is_not_leaf(leaf):
+                edge = tree.select_child(leaf)
+                path.append(edge)
+                if tree.edge_action[edge] == PASS:
+                    game.pass_turn()
+                    undo_records.append(None)
+                else:
+                    undo_records.append(
+                        game.play_action(tree.edge_action[edge]))
+                leaf = tree.child(edge, game.hash)
+
+            if leaf in pending:
+                collisions.append(path)
+            else:
+                valid_moves = game.get_valid_moves(game.current_player)
+                game_over, wsa = game.check_game_over(game.current_player)
+                leaves.append(Leaf(leaf, path, game.get_network_input(),
+                                   game.hash, valid_moves, game_over, wsa))
+                pending.add(leaf)
+            tree.add_virtual_loss(root, path)
+
+            for record in reversed(undo_records):
+                if record is None:
+                    game.pass_turn()
+                else:
+                    game.undo_action(record)
+
+        return leaves, collisions
+
+    def add_dirichlet_noise(self, psas):
+        """Add Dirichlet noise to the move probabilities of the root node.
+
+        This is for additional exploration. The noise is spread over the
+        valid moves only, so the result still sums to 1.
+
+        Args:
+            psas: An array of the probabilities of the valid moves.
+
+        Returns:
+            An array of the probabilities with Dirichlet noise added to it.
+        """
+        if len(psas) == 0:
+            return psas
 
-        for idx, psa in enumerate(psa_vector):
-            noisy_psa_vector.append(
-                (1 - CFG.epsilon) * psa + CFG.epsilon * dirichlet_list[idx])
+        dirichlet_list = np.random.dirichlet(
+            np.full(len(psas), CFG.dirichlet_alpha))
 
-        return noisy_psa_vector
+        return (1 - CFG.epsilon) * psas + CFG.epsilon * dirichlet_list
@@ -27,6 +27,28 @@ import tensorflow as tf
 import numpy as np
 
 from config import CFG
+from eval_cache import EvaluationCache
+
+
+def dense_policy(pi, action_size):
+    """Returns a training target policy as a probability vector.
+
+    Args:
+        pi: A probability vector, or a sparse (actions, probabilities)
+            tuple as stored by self-play with CFG.sparse_policy.
+        action_size: An integer for the length of the vector.
+
+    Returns:
+        An action_size probability vector.
+    """
+    if not isinstance(pi, tuple):
+        return pi
+
+    actions, probs = pi
+    vector = np.zeros(action_size, dtype=np.float32)
+    vector[actions] = probs
+
+    return vector
 
 
 class NeuralNetwork(object):
@@ -36,9 +58,20 @@ class NeuralNetwork(object):
         row: An integer indicating the length of the board row.
         column: An integer indicating the length of the board column.
         action_size: An integer indicating the total number of board squares.
+        input_shape: A list of the dimensions of one state fed to the network.
+        input_dtype: The NumPy dtype of the states fed to the network.
         pi: A TF tensor for the search probabilities.
+        legal_mask: A TF tensor for the valid moves of each state, 1 for
+            valid moves, else 0. All moves are valid if it is not fed.
+        masked_pi: A TF tensor for the search probabilities restricted to
+            the valid moves and renormalized.
+        legal_indices: A TF tensor of (state row, action) pairs to compute
+            sparse_pi for, grouped by state row.
+        sparse_pi: A TF tensor for the search probabilities of only the
+            legal_indices pairs, normalized per state.
         v: A TF tensor for the search values.
-        states: A TF tensor with the dimensions of the board.
+        states: A TF tensor with the dimensions of the board, or of the
+            game's feature planes with CFG.input_features.
         training: A TF boolean scalar tensor.
         train_pis: A TF tensor for the target search probabilities.
         train_vs: A TF tensor for the target search values.
@@ -58,15 +91,29 @@ class NeuralNetwork(object):
         self.pi = None
         self.v = None
 
+        if CFG.input_features:
+            self.input_shape = [game.feature_planes, self.row, self.column]
+            self.input_dtype = np.uint8
+        else:
+            self.input_shape = [self.row, self.column]
+            self.input_dtype = np.float32
+
         self.graph = tf.Graph()
         with self.graph.as_default():
-            self.states = tf.placeholder(tf.float32,
-                                         shape=[None, self.row, self.column])
             self.training = tf.placeholder(tf.bool)
 
             # Input Layer
-            input_layer = tf.reshape(self.states,
-                                     [-1, self.row, self.column, 1])
+            if CFG.input_features:
+                # The uint8 planes are converted to floats in the graph.
+                self.states = tf.placeholder(tf.uint8,
+                                             shape=[None] + self.input_shape)
+                input_layer = tf.transpose(tf.cast(self.states, tf.float32),
+                                           [0, 2, 3, 1])
+            else:
+                self.states = tf.placeholder(tf.float32,
+                                             shape=[None] + self.input_shape)
+                input_layer = tf.reshape(self.states,
+                                         [-1, self.row, self.column, 1])
 
             # Convolutional Block
             conv1 = tf.layers.conv2d(
@@ -119,26 +166,59 @@ class NeuralNetwork(object):
                 resnet_in_out = tf.nn.relu(resnet_skip)
 
             # Policy Head
-            conv4 = tf.layers.conv2d(
-                inputs=resnet_in_out,
-                filters=2,
-                kernel_size=[1, 1],
-                padding="same",
-                strides=1)
+            if CFG.policy_head == "conv":
+                logits = self.conv_policy_head(resnet_in_out)
+            else:
+                conv4 = tf.layers.conv2d(
+                    inputs=resnet_in_out,
+                    filters=2,
+                    kernel_size=[1, 1],
+                    padding="same",
+                    strides=1)
 
-            batch_norm4 = tf.layers.batch_normalization(
-                inputs=conv4,
-                training=self.training
-            )
+                batch_norm4 = tf.layers.batch_normalization(
+                    inputs=conv4,
+                    training=self.training
+                )
 
-            relu4 = tf.nn.relu(batch_norm4)
+                relu4 = tf.nn.relu(batch_norm4)
 
-            relu4_flat = tf.reshape(relu4, [-1, self.row * self.column * 2])
+                relu4_flat = tf.reshape(relu4, [-1, self.row * self.column * 2])
 
-            logits = tf.layers.dense(inputs=relu4_flat, units=self.action_size)
+                policy_dense = tf.layers.Dense(units=self.action_size)
+                logits = policy_dense(relu4_flat)
 
             self.pi = tf.nn.softmax(logits)
 
+            # Masked softmax: invalid moves get no probability. The final
+            # product keeps states without any valid move at all zeros.
+            self.legal_mask = tf.placeholder_with_default(
+                tf.ones_like(logits), shape=[None, self.action_size])
+            masked_logits = logits + (self.legal_mask - 1.0) * 1e30
+            self.masked_pi = tf.nn.softmax(masked_logits) * self.legal_mask
+
+            # Sparse policy: only the logits of the legal moves are used,
+            # followed by a softmax over each state's moves. The dense head
+            # computes them from the matching columns of its dense layer.
+            self.legal_indices = tf.placeholder(tf.int32, shape=[None, 2])
+            rows = self.legal_indices[:, 0]
+            if CFG.policy_head == "conv":
+                sparse_logits = tf.gather_nd(logits, self.legal_indices)
+            else:
+                columns = tf.gather(policy_dense.kernel,
+                                    self.legal_indices[:, 1], axis=1)
+                sparse_logits = tf.reduce_sum(
+                    tf.gather(relu4_flat, rows) * tf.transpose(columns), axis=1)
+                sparse_logits += tf.gather(policy_dense.bias,
+                                           self.legal_indices[:, 1])
+            # The batch size comes from the input, so that the dense head's
+            # full logits stay out of sparse_pi's dependencies.
+            num_states = tf.shape(self.states)[0]
+            sparse_exp = tf.exp(sparse_logits - tf.gather(
+                tf.unsorted_segment_max(sparse_logits, rows, num_states), rows))
+            self.sparse_pi = sparse_exp / tf.gather(
+                tf.unsorted_segment_sum(sparse_exp, rows, num_states), rows)
+
             # Value Head
             conv5 = tf.layers.conv2d(
                 inputs=resnet_in_out,
@@ -204,6 +284,45 @@ class NeuralNetwork(object):
             self.sess.run(tf.global_variables_initializer())
 
 
+    def conv_policy_head(self, features):
+        """Builds the fully convolutional policy head.
+
+        Actions are numbered cell * 91 + shift + orientation, so one output
+        plane per (shift + orientation) over the board, flattened in
+        (row, column, plane) order, lines up with the action numbers.
+
+        Args:
+            features: A TF tensor of the residual tower output.
+
+        Returns:
+            A TF tensor of the (N, action_size) policy logits.
+        """
+        planes = self.action_size // (self.row * self.column)
+
+        conv = tf.layers.conv2d(
+            inputs=features,
+            filters=128,
+            kernel_size=[3, 3],
+            padding="same",
+            strides=1)
+
+        batch_norm = tf.layers.batch_normalization(
+            inputs=conv,
+            training=self.training
+        )
+
+        relu = tf.nn.relu(batch_norm)
+
+        conv_planes = tf.layers.conv2d(
+            inputs=relu,
+            filters=planes,
+            kernel_size=[1, 1],
+            padding="same",
+            strides=1)
+
+        return tf.reshape(conv_planes, [-1, self.row * self.column * planes])
+
+
 class NeuralNetworkWrapper(object):
     """Wrapper class for the NeuralNetwork class.
 
@@ -211,6 +330,8 @@ class NeuralNetworkWrapper(object):
         game: An object containing the game state.
         net: An object containing the neural network.
         sess: A TF session for running Ops on the Graph.
+        cache: An EvaluationCache of the predictions of the current weights.
+        buffer: An array reused to feed batches of states.
     """
 
     def __init__(self, game):
@@ -218,23 +339,159 @@ class NeuralNetworkWrapper(object):
         self.game = game
         self.net = NeuralNetwork(self.game)
         self.sess = self.net.sess
+        self.cache = EvaluationCache(CFG.eval_cache_size,
+                                     CFG.eval_cache_memory * 2 ** 20)
+        self.buffer = np.zeros([0] + self.net.input_shape,
+                               dtype=self.net.input_dtype)
 
-    def predict(self, state):
+    def predict(self, state, key=None, valid_moves=None):
         """Predicts move probabilities and state values given a game state.
 
         Args:
             state: A list containing the game state in matrix form.
+            key: An optional hash of the position, see
+                BlokusGame.compute_hash, to look up and store the
+                prediction in the cache.
+            valid_moves: An optional vector of the valid moves to restrict
+                the probabilities to.
 
         Returns:
             A probability vector and a value scalar
         """
-        state = state[np.newaxis, :, :]
+        keys = None if key is None else [key]
+        if valid_moves is not None:
+            valid_moves = np.asarray(valid_moves)[np.newaxis, :]
+        pis, vs = self.predict_batch(np.asarray(state)[np.newaxis, :, :], keys,
+                                     valid_moves)
+
+        return pis[0], vs[0]
+
+    def input_buffer(self, size):
+        """Returns a reusable array for size states.
+
+        Callers can write states into it and pass it to predict_batch, which
+        then feeds it to the network without converting it. The contents are
+        overwritten by the next call of predict_batch.
+
+        Args:
+            size: An integer for the number of states.
+
+        Returns:
+            An array of size states of the network's input shape and dtype.
+        """
+        if len(self.buffer) < size:
+            self.buffer = np.zeros([max(size, 2 * len(self.buffer))] +
+                                   self.net.input_shape,
+                                   dtype=self.net.input_dtype)
+
+        return self.buffer[:size]
 
-        pi, v = self.sess.run([self.net.pi, self.net.v],
-                              feed_dict={self.net.states: state,
-                                         self.net.training: False})
+    def predict_batch(self, states, keys=None, valid_moves=None):
+        """Predicts move probabilities and state values for several states.
 
-        return pi[0], v[0][0]
+        Only the states whose key is not in the cache are run through the
+        network, each distinct key once. The cache is only used when both
+        keys and valid_moves are given.
+
+        Args:
+            states: An array of game states in matrix form, shaped
+                (N, row, column), for example one from input_buffer.
+            keys: An optional sequence of N position hashes for the cache.
+            valid_moves: An optional (N, action_size) array of the valid
+                moves. If given, the network's masked softmax restricts the
+                probabilities to them and renormalizes them.
+
+        Returns:
+            An (N, action_size) array of probability vectors and an (N,)
+            array of values. With CFG.sparse_policy and valid_moves given,
+            a list of N arrays replaces the probability vectors, holding
+            the probabilities of the valid moves in action order.
+        """
+        if (keys is None or valid_moves is None or
+                self.cache.max_entries <= 0):
+            return self.run_network(states, valid_moves)
+
+        if CFG.sparse_policy:
+            pis = [None] * len(states)
+        else:
+            pis = np.zeros((len(states), self.game.action_size),
+                           dtype=np.float32)
+        vs = np.empty(len(states), dtype=np.float32)
+        missing = {}  # Rows of each key that is not cached.
+
+        # A position's valid moves follow from its key, so the cache only
+        # keeps the probabilities of the valid moves, in action order.
+        for i, key in enumerate(keys):
+            entry = self.cache.get(key)
+            if entry is None:
+                missing.setdefault(key, []).append(i)
+                continue
+
+            probs, vs[i] = entry
+            if CFG.sparse_policy:
+                pis[i] = probs
+            else:
+                pis[i, np.flatnonzero(valid_moves[i])] = probs
+
+        if missing:
+            rows = [indices[0] for indices in missing.values()]
+            new_pis, new_vs = self.run_network(np.asarray(states)[rows],
+                                               valid_moves[rows])
+
+            for (key, indices), row, pi, v in zip(missing.items(), rows,
+                                                  new_pis, new_vs):
+                for i in indices:
+                    pis[i] = pi
+                    vs[i] = v
+                if CFG.sparse_policy:
+                    probs = pi.copy()
+                else:
+                    probs = pi[np.flatnonzero(valid_moves[row])]
+                self.cache.put(key, probs, v)
+
+        return pis, vs
+
+    def run_network(self, states, valid_moves=None):
+        """Runs a forward pass of the network without the cache.
+
+        Args:
+            states: An array of game states in matrix form, shaped
+                (N, row, column).
+            valid_moves: An optional (N, action_size) array of the valid
+                moves fed to the masked or the sparse softmax.
+
+        Returns:
+            An (N, action_size) array of probability vectors, or a list of
+            sparse ones as described in predict_batch, and an (N,) array of
+            values.
+        """
+        states = np.asarray(states)
+        if states.dtype != self.net.input_dtype:
+            buffer = self.input_buffer(len(states))
+            buffer[...] = states
+            states = buffer
+
+        if valid_moves is None:
+            pi, v = self.sess.run([self.net.pi, self.net.v],
+                                  feed_dict={self.net.states: states,
+                                             self.net.training: False})
+        elif CFG.sparse_policy:
+            rows, actions = np.nonzero(valid_moves)
+            probs, v = self.sess.run(
+                [self.net.sparse_pi, self.net.v],
+                feed_dict={self.net.states: states,
+                           self.net.legal_indices: np.stack([rows, actions],
+                                                            axis=1),
+                           self.net.training: False})
+            counts = np.count_nonzero(valid_moves, axis=1)
+            pi = np.split(probs, np.cumsum(counts)[:-1])
+        else:
+            pi, v = self.sess.run([self.net.masked_pi, self.net.v],
+                                  feed_dict={self.net.states: states,
+                                             self.net.legal_mask: valid_moves,
+                                             self.net.training: False})
+
+        return pi, v[:, 0]
 
     def train(self, training_data):
         """Trains the network using states, pis and vs from self play games.
@@ -244,6 +501,9 @@ class NeuralNetworkWrapper(object):
         """
         print("\nTraining the network.\n")
 
+        # Predictions of the old weights are stale from here on.
+        self.cache.clear()
+
         for epoch in range(CFG.epochs):
             print("Epoch", epoch + 1)
 
@@ -253,6 +513,7 @@ class NeuralNetworkWrapper(object):
             for i in range(0, examples_num, CFG.batch_size):
                 states, pis, vs = map(list,
                                       zip(*training_data[i:i + CFG.batch_size]))
+                pis = [dense_policy(pi, self.game.action_size) for pi in pis]
 
                 feed_dict = {self.net.states: states,
                              self.net.train_pis: pis,
@@ -303,4 +564,5 @@ class NeuralNetworkWrapper(object):
         file_path = CFG.model_directory + filename
 
         print("Loading model:", filename, "from", CFG.model_directory)
-        self.net.saver.restore(self.sess, file_path)
\ No newline at end of file
+        self.net.saver.restore(self.sess, file_path)
+        self.cache.clear()
\ No newline at end of file
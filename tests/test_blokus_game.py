@@ -0,0 +1,121 @@
+# MIT License
+#
+# Copyright (c) 2019 Yurii Tolochko.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+"""Tests of BlokusGame move generation and make/unmake."""
+import random
+
+import numpy as np
+import pytest
+
+from config import CFG
+from blokus.blokus_game import BlokusGame, CORNER_PLANE, FEATURE_BASE
+
+MOVE_GENERATORS = ["table", "bitboard", "vectorized", "incremental"]
+
+
+def random_game(seed):
+    """Plays a random legal game to the end.
+
+    Args:
+        seed: An integer seeding the choice of moves.
+
+    Returns:
+        The final game, and a list of (game before the move, UndoRecord)
+        pairs, with a None record for each pass.
+    """
+    rng = random.Random(seed)
+    game = BlokusGame()
+    history = []
+    while not game.check_game_over(game.current_player)[0]:
+        actions = np.flatnonzero(game.get_valid_moves(game.current_player))
+        before = game.clone()
+        if len(actions) == 0:
+            game.pass_turn()
+            history.append((before, None))
+        else:
+            history.append((before, game.play_action(rng.choice(actions))))
+    return game, history
+
+
+@pytest.mark.parametrize("move_generator", MOVE_GENERATORS)
+@pytest.mark.parametrize("seed", range(25))
+def test_undo_restores_every_state(monkeypatch, move_generator, seed):
+    monkeypatch.setattr(CFG, "move_generator", move_generator)
+    # play_action and undo_action also check themselves against snapshots.
+    monkeypatch.setattr(CFG, "validate_state", 1)
+    game, history = random_game(seed)
+
+    for before, record in reversed(history):
+        if record is None:
+            game.pass_turn()
+        else:
+            game.undo_action(record)
+        assert game.same_state(before)
+        assert game.hash == game.compute_hash()
+        assert np.array_equal(game.features, game.compute_features())
+
+
+def board_anchors(game, player):
+    """Returns the cells a player can anchor a piece on, from the board alone.
+
+    Args:
+        game: A BlokusGame.
+        player: 1 or -1.
+
+    Returns:
+        A boolean (n, n) array.
+    """
+    own = np.pad(game.state == player, 1)
+    diagonal = own[:-2, :-2] | own[:-2, 2:] | own[2:, :-2] | own[2:, 2:]
+    adjacent = own[:-2, 1:-1] | own[2:, 1:-1] | own[1:-1, :-2] | own[1:-1, 2:]
+    return diagonal & ~adjacent & (game.state == 0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_corner_planes_follow_from_the_board(seed):
+    _, history = random_game(seed)
+
+    for game, _ in history:
+        if game.rounds < 2:
+            continue
+        for player in [1, -1]:
+            plane = game.features[FEATURE_BASE[player] + CORNER_PLANE]
+            assert np.array_equal(plane, board_anchors(game, player))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_move_generators_agree(monkeypatch, seed):
+    rng = random.Random(seed)
+    game = BlokusGame()
+    while not game.check_game_over(game.current_player)[0]:
+        vectors = {}
+        for move_generator in MOVE_GENERATORS:
+            monkeypatch.setattr(CFG, "move_generator", move_generator)
+            vectors[move_generator] = game.get_valid_moves(game.current_player)
+        for move_generator in MOVE_GENERATORS:
+            assert np.array_equal(vectors[move_generator], vectors["table"]), move_generator
+
+        actions = np.flatnonzero(vectors["table"])
+        if len(actions) == 0:
+            game.pass_turn()
+        else:
+            game.play_action(rng.choice(actions))
@@ -0,0 +1,92 @@
+# MIT License
+#
+# Copyright (c) 2019 Yurii Tolochko.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+"""Tests of the EvaluationCache."""
+import numpy as np
+
+from eval_cache import EvaluationCache
+
+
+def probs(size):
+    """Returns a float32 array of size probabilities, 4 * size bytes."""
+    return np.full(size, 1.0 / size, dtype=np.float32)
+
+
+def test_get_counts_hits_and_misses():
+    cache = EvaluationCache(4, 1024)
+    cache.put(1, probs(2), 0.5)
+
+    pi, v = cache.get(1)
+    assert np.array_equal(pi, probs(2))
+    assert v == 0.5
+    assert cache.get(2) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entry_bound_evicts_least_recently_used():
+    cache = EvaluationCache(2, 1024)
+    cache.put(1, probs(2), 0.1)
+    cache.put(2, probs(2), 0.2)
+    cache.get(1)  # 2 is now the least recently used.
+    cache.put(3, probs(2), 0.3)
+
+    assert list(cache.entries) == [1, 3]
+    assert cache.evictions == 1
+
+
+def test_byte_bound_evicts_until_it_fits():
+    cache = EvaluationCache(10, 40)
+    cache.put(1, probs(4), 0.1)  # 16 bytes
+    cache.put(2, probs(4), 0.2)  # 32 bytes
+    cache.put(3, probs(8), 0.3)  # 64 bytes, 1 and 2 must go.
+
+    assert list(cache.entries) == [3]
+    assert cache.num_bytes == 32
+    assert cache.evictions == 2
+
+
+def test_put_keeps_existing_entries():
+    cache = EvaluationCache(4, 1024)
+    cache.put(1, probs(2), 0.1)
+    cache.put(1, probs(4), 0.9)
+
+    assert cache.get(1)[1] == 0.1
+    assert cache.num_bytes == 8
+
+
+def test_zero_entries_turns_the_cache_off():
+    cache = EvaluationCache(0, 1024)
+    cache.put(1, probs(2), 0.1)
+
+    assert len(cache) == 0
+    assert cache.get(1) is None
+
+
+def test_clear_keeps_the_counters():
+    cache = EvaluationCache(1, 1024)
+    cache.put(1, probs(2), 0.1)
+    cache.put(2, probs(2), 0.2)
+    cache.get(2)
+    cache.clear()
+
+    assert len(cache) == 0 and cache.num_bytes == 0
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 0, 1)
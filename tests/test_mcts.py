@@ -0,0 +1,227 @@
+# MIT License
+#
+# Copyright (c) 2019 Yurii Tolochko.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+"""Tests of the MCTS search tree with a stub network."""
+import random
+
+import numpy as np
+import pytest
+
+from config import CFG
+from blokus.blokus_game import BlokusGame
+from mcts import PASS, MonteCarloTreeSearch, TreeNode
+
+
+class StubNetwork(object):
+    """Answers predict_batch with random outputs seeded by position hash."""
+
+    def predict_batch(self, states, keys=None, valid_moves=None):
+        pis = []
+        vs = []
+        for key, valid in zip(keys, valid_moves):
+            rng = np.random.RandomState(key % 2 ** 32)
+            pi = rng.rand(len(valid)) * valid
+            pi /= max(pi.sum(), 1e-9)
+            if CFG.sparse_policy:
+                pi = pi[np.flatnonzero(valid)]
+            pis.append(pi)
+            vs.append(rng.uniform(-1, 1))
+        if not CFG.sparse_policy:
+            pis = np.array(pis)
+        return pis, np.array(vs)
+
+
+@pytest.fixture(params=[(0, 1, 0), (0, 8, 0), (1, 1, 0), (1, 8, 0), (0, 8, 1),
+                        (1, 8, 1)],
+                ids=lambda p: "dag{}-batch{}-sparse{}".format(*p))
+def search_config(request, monkeypatch):
+    transpositions, batch_size, sparse_policy = request.param
+    monkeypatch.setattr(CFG, "transpositions", transpositions)
+    monkeypatch.setattr(CFG, "mcts_batch_size", batch_size)
+    monkeypatch.setattr(CFG, "sparse_policy", sparse_policy)
+    monkeypatch.setattr(CFG, "num_mcts_sims", 40)
+    np.random.seed(0)
+
+
+def check_statistics(tree):
+    """Asserts that the visits and values of a tree are consistent.
+
+    After a search no virtual loss may be left: each edge's Q is its W / N,
+    unvisited edges have no value and every expanded node was visited once
+    more than its edges. In a tree, a node's visits and value are those of
+    the edge leading to it. In a DAG, nodes may also have been visited
+    through parents that were freed since.
+    """
+    edges = slice(0, tree.num_edges)
+    nsa = tree.edge_N[edges]
+    wsa = tree.edge_W[edges]
+    visited = nsa > 0
+    assert (nsa >= 0).all()
+    assert np.allclose(tree.edge_Q[edges][visited],
+                       wsa[visited] / nsa[visited])
+    assert not wsa[~visited].any()
+    assert not tree.edge_Q[edges][~visited].any()
+
+    children = tree.edge_child[edges]
+    linked = children >= 0
+    incoming_N = np.zeros(tree.num_nodes, dtype=np.int64)
+    incoming_W = np.zeros(tree.num_nodes)
+    np.add.at(incoming_N, children[linked], nsa[linked])
+    np.add.at(incoming_W, children[linked], wsa[linked])
+
+    for node in range(tree.num_nodes):
+        first = tree.node_first[node]
+        count = tree.node_count[node]
+        if count > 0:
+            assert tree.node_N[node] == 1 + nsa[first:first + count].sum()
+
+    if tree.node_table is None:
+        assert (children[~visited] < 0).all()
+        assert (incoming_N[1:] == tree.node_N[1:tree.num_nodes]).all()
+        assert np.allclose(incoming_W[1:], tree.node_W[1:tree.num_nodes])
+    else:
+        assert (incoming_N <= tree.node_N[:tree.num_nodes]).all()
+
+
+def check_subtree(old, old_node, new, new_node=0, remap=None):
+    """Asserts that new holds a copy of everything reachable from old_node.
+
+    Returns:
+        A dict mapping the old nodes to the new ones.
+    """
+    if remap is None:
+        remap = {}
+    if old_node in remap:
+        assert remap[old_node] == new_node
+        return remap
+    remap[old_node] = new_node
+
+    assert old.node_N[old_node] == new.node_N[new_node]
+    assert old.node_W[old_node] == new.node_W[new_node]
+    assert old.node_count[old_node] == new.node_count[new_node]
+    for k in range(old.node_count[old_node]):
+        old_edge = old.node_first[old_node] + k
+        new_edge = new.node_first[new_node] + k
+        for name in ["edge_N", "edge_W", "edge_Q", "edge_P", "edge_action"]:
+            assert getattr(old, name)[old_edge] == getattr(new, name)[new_edge]
+        old_child = old.edge_child[old_edge]
+        new_child = new.edge_child[new_edge]
+        assert (old_child < 0) == (new_child < 0)
+        if old_child >= 0:
+            check_subtree(old, old_child, new, new_child, remap)
+    return remap
+
+
+def test_search_statistics_stay_consistent(search_config):
+    game = BlokusGame()
+    mcts = MonteCarloTreeSearch(StubNetwork())
+    node = TreeNode()
+
+    for _ in range(6):
+        best_child, _ = mcts.search(game, node, 1)
+        check_statistics(node.tree)
+        game.play_action(best_child.action)
+        node = mcts.advance(node, best_child.action, game)
+        check_statistics(node.tree)
+
+    assert mcts.reused_visits > 0
+
+
+def test_subtree_copies_what_is_reachable(search_config):
+    game = BlokusGame()
+    mcts = MonteCarloTreeSearch(StubNetwork())
+    node = TreeNode()
+    for _ in range(3):
+        best_child, _ = mcts.search(game, node, 1)
+        game.play_action(best_child.action)
+        node = mcts.advance(node, best_child.action, game)
+    mcts.search(game, node, 1)
+
+    tree = node.tree
+    first = tree.node_first[0]
+    child = tree.edge_child[first + np.argmax(
+        tree.edge_N[first:first + tree.node_count[0]])]
+    subtree = tree.subtree(child)
+    remap = check_subtree(tree, child, subtree)
+
+    assert subtree.num_nodes == len(remap)
+    assert subtree.num_edges == sum(tree.node_count[old] for old in remap)
+    if tree.node_table is not None:
+        assert subtree.node_table == {
+            key: remap[node] for key, node in tree.node_table.items()
+            if node in remap}
+
+
+def position_before_pass():
+    """Returns a random game where the player to move has to pass.
+
+    The other player still has plenty of moves, so the game goes on.
+    """
+    for seed in range(100):
+        rng = random.Random(seed)
+        game = BlokusGame()
+        while not game.check_game_over(game.current_player)[0]:
+            actions = np.flatnonzero(game.get_valid_moves(game.current_player))
+            if len(actions) > 0:
+                game.play_action(rng.choice(actions))
+            elif game.get_valid_moves(-game.current_player).sum() >= 20:
+                return game
+            else:
+                game.pass_turn()
+    raise AssertionError("no random game has a pass")
+
+
+def test_search_walks_through_passes(search_config):
+    # The player who has to pass cannot move after any move of the other
+    # player either, so the search passes for them again and again.
+    game = position_before_pass()
+    game.pass_turn()
+    before = game.clone()
+    mcts = MonteCarloTreeSearch(StubNetwork())
+    node = TreeNode()
+
+    best_child, _ = mcts.search(game, node, 1)
+    tree = node.tree
+    passes = tree.edge_action[:tree.num_edges] == PASS
+    assert tree.edge_N[:tree.num_edges][passes].sum() > 0
+    check_statistics(tree)
+    assert game.same_state(before)
+
+    # The position after the move has a searched pass edge to reuse.
+    game.play_action(best_child.action)
+    node = mcts.advance(node, best_child.action, game)
+    tree = node.tree
+    assert tree.edge_action[tree.node_first[0]] == PASS
+    visits = tree.node_N[tree.edge_child[tree.node_first[0]]]
+    assert visits > 0
+
+    best_child, prob_vector = mcts.search(game, node, 1)
+    assert best_child is None
+    assert not prob_vector.any()
+
+    game.pass_turn()
+    reused_visits = mcts.reused_visits
+    node = mcts.advance(node, None, game)
+    assert node.action is None
+    assert node.tree.node_N[0] == visits
+    assert mcts.reused_visits == reused_visits + visits
+    check_statistics(node.tree)
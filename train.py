@@ -21,11 +21,16 @@
 # SOFTWARE.
 # ==============================================================================
 """Class to train the Neural Network."""
+import asyncio
+import multiprocessing
+import traceback
+
 import numpy as np
 
 from config import CFG
-from mcts import MonteCarloTreeSearch, TreeNode
+from mcts import MonteCarloTreeSearch, TreeNode, run_steps, run_steps_async
 from neural_net import NeuralNetworkWrapper
+from inference_server import AsyncEvaluator, InferenceServer, RemoteNetwork
 from evaluate import Evaluate
 from copy import deepcopy
 
@@ -38,35 +43,175 @@ class Train(object):
         net: An object containing the neural network.
     """
 
-    def __init__(self, game, net):
-        """Initializes Train with the board state and neural network."""
+    def __init__(self, game, net, eval_net=None):
+        """Initializes Train with the board state and neural network.
+
+        A new network is created for evaluation unless eval_net is given.
+        """
         self.game = game
         self.net = net
-        self.eval_net = NeuralNetworkWrapper(game)
+        if eval_net is None:
+            eval_net = NeuralNetworkWrapper(game)
+        self.eval_net = eval_net
 
     def start(self):
         """Main training loop."""
         for i in range(CFG.num_iterations):
             print("Iteration", i + 1)
 
-            training_data = []  # list to store self play states, pis and vs
+            if CFG.num_workers > 1:
+                training_data = self.play_games_parallel()
+            else:
+                training_data = self.play_games(CFG.num_games)
 
-            for j in range(CFG.num_games):
-                print("Start Training Self-Play Game", j + 1)
-                game = deepcopy(self.game)#.clone()  # Create a fresh clone for each game.
-                self.play_game(game, training_data)
+            cache = self.net.cache
+            print("Evaluation cache:", cache.hits, "hits,", cache.misses,
+                  "misses,", cache.evictions, "evictions")
 
             
             # Train the network using self play values.
             self.net.train(training_data)
             self.net.save_model()
             
+    def play_games(self, num_games):
+        """Plays self-play games in this process.
+
+        With CFG.async_games above 1, that many games are played at once as
+        coroutines sharing batched evaluations of self.net.
+
+        Args:
+            num_games: An integer for the number of games to play.
+
+        Returns:
+            A list of the self play states, pis and vs of all games.
+        """
+        training_data = []  # list to store self play states, pis and vs
+
+        if CFG.async_games > 1:
+            asyncio.run(self.play_games_async(num_games, training_data))
+        else:
+            for j in range(num_games):
+                print("Start Training Self-Play Game", j + 1)
+                game = self.game.clone()  # Create a fresh clone for each game.
+                self.play_game(game, training_data)
+
+        return training_data
+
+    async def play_games_async(self, num_games, training_data):
+        """Plays num_games games, CFG.async_games of them at a time.
+
+        Args:
+            num_games: An integer for the number of games to play.
+            training_data: A list to store self play states, pis and vs.
+        """
+        evaluator = AsyncEvaluator(self.net, CFG.eval_batch_size,
+                                   CFG.eval_timeout)
+        game_numbers = iter(range(num_games))
+        lanes = min(CFG.async_games, num_games)
+
+        await evaluator.run([self.play_lane(game_numbers, training_data,
+                                            evaluator) for _ in range(lanes)])
+
+    async def play_lane(self, game_numbers, training_data, evaluator):
+        """Plays games one after another until game_numbers is exhausted.
+
+        Args:
+            game_numbers: An iterator over the numbers of the games to play,
+                shared by all lanes.
+            training_data: A list to store self play states, pis and vs.
+            evaluator: The AsyncEvaluator shared by all lanes.
+        """
+        for j in game_numbers:
+            print("Start Training Self-Play Game", j + 1)
+            await self.play_game_async(self.game.clone(), training_data,
+                                       evaluator)
+
+    def play_games_parallel(self):
+        """Plays CFG.num_games self-play games in CFG.num_workers processes.
+
+        The workers only run MCTS. Their leaf states are evaluated by an
+        InferenceServer in this process, which batches the requests of all
+        workers into shared forward passes of self.net. If any worker fails,
+        the others are terminated.
+
+        Returns:
+            A list of the self play states, pis and vs of all games.
+
+        Raises:
+            RuntimeError: A worker failed, with its traceback.
+        """
+        context = multiprocessing.get_context("spawn")
+        # Spawned workers re-import config, so they get the current values.
+        config = {key: value for key, value in vars(CFG).items()
+                  if not key.startswith("__")}
+
+        connections = []
+        workers = []
+        try:
+            for w in range(CFG.num_workers):
+                num_games = CFG.num_games // CFG.num_workers
+                if w < CFG.num_games % CFG.num_workers:
+                    num_games += 1
+                if num_games == 0:
+                    continue
+
+                server_end, worker_end = context.Pipe()
+                worker = context.Process(
+                    target=self_play_worker,
+                    args=(worker_end, self.game, num_games, config,
+                          np.random.randint(2 ** 31)))
+                worker.start()
+                worker_end.close()
+                connections.append(server_end)
+                workers.append(worker)
+
+            print("Start", CFG.num_games, "Self-Play Games in", len(workers),
+                  "Workers")
+            results = InferenceServer(self.net, connections).serve()
+        except BaseException:
+            # The other workers may be blocked waiting for predictions.
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            for connection in connections:
+                connection.close()
+
+        return [example for result in results for example in result]
+
     def play_game(self, game, training_data):
         """Loop for each self-play game.
 
         Runs MCTS for each game state and plays a move based on the MCTS output.
         Stops when the game is over and prints out a winner.
 
+        Args:
+            game: An object containing the game state.
+            training_data: A list to store self play states, pis and vs.
+        """
+        run_steps(self.play_game_steps(game, training_data),
+                  self.net.predict_batch)
+
+    async def play_game_async(self, game, training_data, evaluator):
+        """Coroutine version of play_game awaiting the evaluator.
+
+        Args:
+            game: An object containing the game state.
+            training_data: A list to store self play states, pis and vs.
+            evaluator: An AsyncEvaluator batching the leaves of many games.
+        """
+        await run_steps_async(self.play_game_steps(game, training_data),
+                              evaluator.evaluate)
+
+    def play_game_steps(self, game, training_data):
+        """Generator running the self-play loop of play_game.
+
+        Yields the leaf states, position hashes and valid moves of each MCTS
+        batch and expects to be sent the network's move probabilities and
+        values for them.
+
         Args:
             game: An object containing the game state.
             training_data: A list to store self play states, pis and vs.
@@ -82,18 +227,30 @@ class Train(object):
 
         # Keep playing until the game is in a terminal state.
         while not game_over:
+            # Playout cap randomization: only full searches are recorded,
+            # the other moves get a cheap search without noise.
+            full_search = np.random.rand() < CFG.full_search_prob
+            if full_search:
+                num_sims = CFG.num_mcts_sims
+            else:
+                num_sims = CFG.fast_mcts_sims
+
             # MCTS simulations to get the best child node.
             if count < CFG.temp_thresh:
-                best_child, prob_vector = mcts.search(game, node, CFG.temp_init)
+                best_child, prob_vector = yield from mcts.search_steps(
+                    game, node, CFG.temp_init, num_sims, full_search)
             else:
-                best_child, prob_vector = mcts.search(game, node, CFG.temp_final)
+                best_child, prob_vector = yield from mcts.search_steps(
+                    game, node, CFG.temp_final, num_sims, full_search)
 
-            # Store state, prob and v for training.
-            if best_child != None:
-                self_play_data.append([deepcopy(game.state),
-                                       deepcopy(prob_vector),
-                                       0])
+            # Store state, prob and the player to move for training. The
+            # player is replaced by the outcome for them at the end.
+            if full_search:
+                self_play_data.append([game.get_network_input(),
+                                       self.policy_target(prob_vector),
+                                       game.current_player])
 
+            if best_child != None:
                 action = best_child.action
                 game.play_action(action)  # Play the child node's action.
                 count += 1
@@ -101,24 +258,44 @@ class Train(object):
 
                 game_over, value = game.check_game_over(game.current_player)
 
-                best_child.parent = None
-                node = best_child  # Make the child node the root node.
+                # Make the child node the root node.
+                node = mcts.advance(node, action, game)
             else:
-                self_play_data.append([deepcopy(game.state),
-                                       deepcopy(prob_vector),
-                                       0])                
-                game.current_player *= -1
+                game.pass_turn()
+                node = mcts.advance(node, None, game)
                 # print('NO ACTION TAKEN, Next player is', game.current_player)
 
         # Update v as the value of the game result.
         print('FINAL SCORES ARE ', game.score)
+        print('Reused visits:', mcts.reused_visits)
+        print('Search stops:', dict(mcts.stats))
+        # value is the outcome for the player to move at the end.
         for game_state in self_play_data:
-            value = -value
-            game_state[2] = value
+            if game_state[2] == game.current_player:
+                game_state[2] = value
+            else:
+                game_state[2] = -value
             self.augment_data(game_state, training_data, game.row, game.column)
 
         # game.print_board()
 
+    def policy_target(self, prob_vector):
+        """Returns the training target for the search probabilities.
+
+        With CFG.sparse_policy, only the moves with a probability are kept
+        as an (actions, probabilities) tuple, see dense_policy.
+
+        Args:
+            prob_vector: A probability vector returned by the search.
+
+        Returns:
+            A copy of prob_vector or its sparse tuple.
+        """
+        if CFG.sparse_policy:
+            actions = np.flatnonzero(prob_vector)
+            return actions, prob_vector[actions]
+        return deepcopy(prob_vector)
+
     def augment_data(self, game_state, training_data, row, column):
         """Loop for each self-play game.
 
@@ -149,3 +326,32 @@ class Train(object):
         #                               np.fliplr(
         #                                   np.rot90(psa_vector, i)).flatten(),
         #                               game_state[2]])
+
+
+def self_play_worker(connection, game, num_games, config, seed):
+    """Plays self-play games in a worker process of Train.play_games_parallel.
+
+    Args:
+        connection: The worker's end of the pipe to the InferenceServer.
+        game: An object containing the initial game state.
+        num_games: An integer for the number of games to play.
+        config: A dict of the CFG values of the parent process.
+        seed: An integer to seed this worker's Dirichlet noise.
+    """
+    for key, value in config.items():
+        setattr(CFG, key, value)
+    np.random.seed(seed)
+
+    net = RemoteNetwork(connection)
+    train = Train(game, net, eval_net=net)
+    try:
+        training_data = train.play_games(num_games)
+    except Exception:
+        # Hand the traceback to the parent, which would only see the pipe
+        # close otherwise.
+        connection.send(("error", traceback.format_exc()))
+        raise
+    else:
+        connection.send(("done", training_data))
+    finally:
+        connection.close()